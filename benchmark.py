@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from configlib import DEFAULT_CONFIG, load_config
+from data_driven_qcd import (fit_tf, job_tags, make_templates, tf_prediction,
+                             write_prediction)
+from fitlib import TFFit, exponential, get_model
+from plotlib import configure
+from storelib import TemplateStore, merge_fit_stores, merge_template_stores
+from templatelib import GROUPS, QCDTensor
+
+pjoin = os.path.join
+
+# Per-event weight of the synthetic MC, sets sumw2 = MC_WEIGHT * sumw
+MC_WEIGHT = 0.1
+
+def expected(recoil_edges, dphi_edges):
+    '''
+    Smooth recoil vs dphi densities for QCD and non-QCD, with a
+    TF falling roughly exponentially in recoil like the real one.
+    '''
+    r = 0.5*(recoil_edges[1:]+recoil_edges[:-1])[:, None]
+    d = 0.5*(dphi_edges[1:]+dphi_edges[:-1])[None, :]
+    width = np.diff(recoil_edges)[:, None] * np.diff(dphi_edges)[None, :]
+    qcd = 1e8 * width * np.exp(-r/150) * np.exp(-d*(3+r/100))
+    nonqcd = 1e6 * width * np.exp(-r/300) * np.ones_like(d)
+    return qcd, nonqcd
+
+def synthetic_datasets(ndatasets, year):
+    '''
+    Dataset names per group, matching the default group patterns.
+    '''
+    nmc = max(ndatasets - 1, 2)
+    nonqcd = ['ZJetsToNuNu_HT-{i}', 'Top_FXFX_{i}', 'Diboson_{i}', 'DYJetsToLL_M-50_HT_MLM_{i}', 'WJetsToLNu_HT-{i}']
+    return {
+        'qcd' : [f'QCD_HT{100*(i+1)}-mg_{year}' for i in range(nmc//2)],
+        'nonqcd' : [nonqcd[i % len(nonqcd)].format(i=i) + f'_{year}' for i in range(nmc - nmc//2)],
+        'data' : [f'MET_{year}'],
+    }
+
+def synthetic_tensor(regions, years, recoil_edges, dphi_edges, seed=1):
+    '''
+    QCDTensor with fluctuated QCD, non-QCD and data content.
+    '''
+    rng = np.random.default_rng(seed)
+    qcd, nonqcd = expected(recoil_edges, dphi_edges)
+    shape = (len(regions), len(GROUPS), len(years), len(recoil_edges)+2, len(dphi_edges)+2)
+    sumw = np.zeros(shape)
+    sumw2 = np.zeros(shape)
+    for ireg in range(len(regions)):
+        for iyear in range(len(years)):
+            mc = [MC_WEIGHT * rng.poisson(x / MC_WEIGHT) for x in (qcd, nonqcd)]
+            data = rng.poisson(qcd + nonqcd).astype(float)
+            for igroup, (w, w2) in enumerate([(mc[0], MC_WEIGHT*mc[0]), (mc[1], MC_WEIGHT*mc[1]), (data, data)]):
+                sumw[ireg, igroup, iyear, 1:-2, 1:-2] = w
+                sumw2[ireg, igroup, iyear, 1:-2, 1:-2] = w2
+    return QCDTensor(regions, GROUPS, years, recoil_edges, dphi_edges, sumw, sumw2)
+
+def synthetic_hist(tensor, ndatasets):
+    '''
+    coffea histogram with dataset and region axes and the content of a synthetic tensor,
+    split evenly over the datasets of every group.
+    '''
+    from coffea import hist
+
+    h = hist.Hist(
+                "Events",
+                hist.Cat("dataset", "Dataset"),
+                hist.Cat("region", "Region"),
+                hist.Bin("recoil", "Recoil (GeV)", tensor.recoil_edges),
+                hist.Bin("dphi", r"$\Delta\phi$", tensor.dphi_edges),
+                )
+    r = 0.5*(tensor.recoil_edges[1:]+tensor.recoil_edges[:-1])
+    d = 0.5*(tensor.dphi_edges[1:]+tensor.dphi_edges[:-1])
+    rr, dd = [x.ravel() for x in np.meshgrid(r, d, indexing='ij')]
+    for ireg, region in enumerate(tensor.regions):
+        for iyear, year in enumerate(tensor.years):
+            for igroup, datasets in enumerate(synthetic_datasets(ndatasets, year).values()):
+                w = tensor.sumw[ireg, igroup, iyear, 1:-2, 1:-2].ravel() / len(datasets)
+                for dataset in datasets:
+                    h.fill(dataset=dataset, region=region, recoil=rr, dphi=dd, weight=w)
+    return h
+
+def measure(fun, repeat):
+    '''
+    Best wall time out of repeat calls, followed by one call under tracemalloc for the peak memory.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fun()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, dict(wall_s=min(times), wall_s_all=times, peak_mem_mb=peak/1e6)
+
+def parse_commandline():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the QCD estimate on synthetic input.')
+    parser.add_argument('--datasets', type=int, default=50, help='Number of datasets per year in the synthetic histogram.')
+    parser.add_argument('--recoil-bins', type=int, default=200, help='Number of fine recoil bins between 0 and 2000 GeV.')
+    parser.add_argument('--dphi-bins', type=int, default=64, help='Number of fine dphi bins between 0 and pi.')
+    parser.add_argument('--years', type=int, nargs='+', default=[2017, 2018], help='Years to generate.')
+    parser.add_argument('--regions', type=int, default=3, help='Number of regions to generate, at most the number of configured regions.')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG, help='Config with the recoil binnings and dphi cuts.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed repetitions per stage.')
+    parser.add_argument('--envelope-calls', type=int, default=1000, help='Number of envelope evaluations.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic content.')
+    parser.add_argument('--workdir', type=str, default=None, help='Directory for the stage outputs, temporary by default.')
+    parser.add_argument('--output', '-o', type=str, default='benchmark.json', help='Output JSON file.')
+    return parser.parse_args()
+
+def main():
+    args = parse_commandline()
+    config = load_config(args.config)
+
+    # The configured regions, which all use the binnings of the first one
+    if args.regions > len(config['regions']):
+        raise ValueError(f"At most {len(config['regions'])} regions are configured")
+    bins = config['bins'][config['regions'][0]]
+    regions = config['regions'][:args.regions]
+    years = args.years
+    recoil_edges = np.linspace(0, 2000, args.recoil_bins+1)
+    dphi_edges = np.linspace(0, np.pi, args.dphi_bins+1)
+    tags = [(bintag, tag, dphi_cr, dphi_sr) for bintag in bins for tag, dphi_cr, dphi_sr in job_tags(config, bintag)]
+    njobs = len(regions) * len(years) * len(tags)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='qcd_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    configure(None)
+
+    tensor = synthetic_tensor(regions, years, recoil_edges, dphi_edges, seed=args.seed)
+    stages = {}
+
+    try:
+        h = synthetic_hist(tensor, args.datasets)
+    except ImportError as e:
+        stages['from_hist'] = dict(skipped=str(e))
+    else:
+        _, stages['from_hist'] = measure(lambda: QCDTensor.from_hist(h, regions, years), args.repeat)
+
+    def templates():
+        for region in regions:
+            for year in years:
+                for bintag, tag, dphi_cr, dphi_sr in tags:
+                    make_templates(tensor, workdir, tag, bins[bintag], region, year, dphi_cr, dphi_sr)
+    _, stages['make_templates'] = measure(templates, args.repeat)
+
+    def fits():
+        for region in regions:
+            for year in years:
+                for _, tag, _, _ in tags:
+                    fit_tf(workdir, tag, region, year)
+    _, stages['fit_tf'] = measure(fits, args.repeat)
+
+    # The bare fits, without reading and writing the stores
+    inputs = []
+    for region in regions:
+        for year in years:
+            for _, tag, _, _ in tags:
+                h = TemplateStore(pjoin(workdir, f"templates_{region}_{tag}_{year}.npy")).get(tag, f"{region}_{year}_tf")
+                x = 0.5*(h.allbins[1:, 0] + h.allbins[1:, 1])
+                x[-1] = h.edges[-1] + 0.5*(h.edges[-1] - h.edges[-2])
+                y = np.array(h.allvalues[1:])
+                dy = np.sqrt(h.allvariances[1:])
+                dy[dy == 0] = np.max(dy)
+                inputs.append((x, y, dy))
+    def tffits():
+        ret = []
+        for x, y, dy in inputs:
+            fit = TFFit(x=x, y=y, dy=dy, fun=exponential, p0=tuple(config['fit']['p0']))
+            fit.fit()
+            ret.append(fit)
+        return ret
+    fitted, stages['tffit'] = measure(tffits, args.repeat)
+
+    # The same fits from the model's guess for the points, as with warm_start
+    model = get_model(config['fit']['model'])
+    def tffits_guess():
+        ret = []
+        for x, y, dy in inputs:
+            guess = model.guess(x, y, dy)
+            fit = TFFit(x=x, y=y, dy=dy, fun=model.fun, p0=guess if guess is not None else tuple(config['fit']['p0']))
+            fit.fit()
+            ret.append(fit)
+        return ret
+    guessed, stages['tffit_guess'] = measure(tffits_guess, args.repeat)
+    for name, fits in [('tffit', fitted), ('tffit_guess', guessed)]:
+        stages[name]['nfev'] = int(sum(fit.nfev for fit in fits))
+
+    # Fresh arrays every call, so the evaluation cache never hits
+    def envelopes():
+        fit = fitted[0]
+        for i in range(args.envelope_calls):
+            fit.envelope(np.linspace(250, 1400 + 1e-6*i, 100))
+    _, stages['envelope'] = measure(envelopes, args.repeat)
+
+    for region in regions:
+        parts = [f"{region}_{tag}_{year}" for _, tag, _, _ in tags for year in years]
+        merge_template_stores([pjoin(workdir, f"templates_{part}.npy") for part in parts], pjoin(workdir, f"templates_{region}.npy"))
+        merge_fit_stores([pjoin(workdir, f"tf_fit_{part}.npy") for part in parts], pjoin(workdir, f"tf_fits_{region}.npy"))
+
+    _, stages['tf_prediction'] = measure(lambda: [tf_prediction(workdir, region, years) for region in regions], args.repeat)
+
+    try:
+        _, stages['write_prediction'] = measure(lambda: write_prediction(workdir, regions), args.repeat)
+    except ImportError as e:
+        stages['write_prediction'] = dict(skipped=str(e))
+
+    throughput = {
+        'from_hist' : (1, 'histograms/s'),
+        'make_templates' : (njobs, 'templates/s'),
+        'fit_tf' : (njobs, 'fits/s'),
+        'tffit' : (njobs, 'fits/s'),
+        'tffit_guess' : (njobs, 'fits/s'),
+        'envelope' : (args.envelope_calls, 'envelopes/s'),
+        'tf_prediction' : (len(regions), 'regions/s'),
+        'write_prediction' : (1, 'files/s'),
+    }
+    for name, stage in stages.items():
+        if 'wall_s' in stage:
+            n, unit = throughput[name]
+            stage['throughput'] = n / stage['wall_s']
+            stage['unit'] = unit
+
+    result = dict(
+        parameters=dict(
+            datasets=args.datasets,
+            recoil_bins=args.recoil_bins,
+            dphi_bins=args.dphi_bins,
+            years=years,
+            regions=args.regions,
+            binnings=list(bins),
+            jobs=njobs,
+            repeat=args.repeat,
+        ),
+        environment=dict(
+            python=sys.version.split()[0],
+            numpy=np.__version__,
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+        ),
+        stages=stages,
+    )
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=1)
+
+    for name, stage in stages.items():
+        if 'skipped' in stage:
+            print(f"{name:>15}: skipped ({stage['skipped']})")
+        else:
+            print(f"{name:>15}: {stage['wall_s']:8.3f} s, {stage['peak_mem_mb']:8.1f} MB, {stage['throughput']:10.1f} {stage['unit']}")
+    nfev, nfev_guess = stages['tffit']['nfev'], stages['tffit_guess']['nfev']
+    print(f"Warm starts from the guess: {nfev_guess} instead of {nfev} evaluations from p0 ({1 - nfev_guess/nfev:.0%} saved)")
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import numpy as np
+
+from templatelib import cumsum0
+
+def fine_edges(edges, lo, hi):
+    '''
+    Fine recoil edges between lo and hi, the range is widened to the closest edges outside.
+    '''
+    edges = np.asarray(edges, dtype=float)
+    first = max(np.searchsorted(edges, lo, side='right') - 1, 0)
+    last = min(np.searchsorted(edges, hi, side='left'), len(edges) - 1)
+    return edges[first:last+1]
+
+def bin_quality(cr_sumw, cr_sumw2, sr_sumw, sr_sumw2):
+    '''
+    Smallest effective number of entries in CR and SR and relative TF uncertainty per bin.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        neff = np.minimum(cr_sumw**2 / cr_sumw2, sr_sumw**2 / sr_sumw2)
+        rel_unc = np.sqrt(sr_sumw2 / sr_sumw**2 + cr_sumw2 / cr_sumw**2)
+    return np.where(np.isfinite(neff), neff, 0), np.where(np.isfinite(rel_unc), rel_unc, np.inf)
+
+def greedy_binning(edges, cr_sumw, cr_sumw2, sr_sumw, sr_sumw2, min_neff, max_rel_unc):
+    '''
+    Merges fine QCD MC bins from low to high recoil until every bin has at least
+    min_neff effective entries in CR and SR and a relative TF uncertainty below max_rel_unc.
+
+    The fine arrays hold one entry per fine bin, without flow bins. A remainder
+    at high recoil that does not satisfy the constraints is merged into the last bin.
+    '''
+    sums = [cumsum0(np.asarray(x, dtype=float)) for x in (cr_sumw, cr_sumw2, sr_sumw, sr_sumw2)]
+    bins = [edges[0]]
+    start = 0
+    for stop in range(1, len(edges)):
+        neff, rel_unc = bin_quality(*[c[stop] - c[start] for c in sums])
+        if neff >= min_neff and rel_unc <= max_rel_unc:
+            bins.append(edges[stop])
+            start = stop
+    if start < len(edges) - 1:
+        if len(bins) > 1:
+            bins[-1] = edges[-1]
+        else:
+            bins.append(edges[-1])
+    return np.array(bins)
+
+def pareto_front(objectives):
+    '''
+    Mask of the points not dominated by any other, all objectives are minimized.
+
+    objectives has the shape (point, objective).
+    '''
+    objectives = np.asarray(objectives, dtype=float)
+    no_worse = np.all(objectives[:, None, :] <= objectives[None, :, :], axis=-1)
+    better = np.any(objectives[:, None, :] < objectives[None, :, :], axis=-1)
+    # dominated[j]: some i is no worse everywhere and better somewhere
+    return ~np.any(no_worse & better, axis=0)
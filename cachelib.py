@@ -0,0 +1,63 @@
+import hashlib
+import os
+import pickle
+
+from tracelib import written
+
+pjoin = os.path.join
+
+# Bump whenever the content of the cached objects changes meaning
+CACHE_VERSION = 1
+
+def fingerprint_directory(indir):
+    '''
+    Hash of the relative path, size and modification time of every file in a directory.
+    '''
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(indir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = pjoin(root, fname)
+            st = os.stat(path)
+            sha.update(f"{os.path.relpath(path, indir)}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+def cache_key(indir, distribution, reweight_pu, extra=()):
+    sha = hashlib.sha256()
+    sha.update(f"v{CACHE_VERSION}:{distribution}:{reweight_pu}:".encode())
+    if extra:
+        sha.update(f"{extra!r}:".encode())
+    sha.update(fingerprint_directory(indir).encode())
+    return sha.hexdigest()
+
+def atomic_pickle(obj, path):
+    '''
+    Pickles to a temporary file first, so readers never see a partial file.
+    '''
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    written(path)
+
+def cached_distribution(indir, distribution, reweight_pu, builder, cachedir, rebuild=False, extra=()):
+    '''
+    Returns the merged and scaled histogram for a distribution.
+
+    The result of builder(indir, distribution, reweight_pu) is stored in cachedir,
+    keyed on the content of indir, the distribution name and the PU flag.
+    Any other settings the builder depends on have to be passed as extra.
+    '''
+    key = cache_key(indir, distribution, reweight_pu, extra)
+    path = pjoin(cachedir, f"{distribution}_{key[:16]}.pkl")
+    if not rebuild and os.path.exists(path):
+        print(f"Loading cached {distribution} from {path}")
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    h = builder(indir, distribution, reweight_pu)
+
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    atomic_pickle(h, path)
+    return h
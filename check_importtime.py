@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must not be loaded just by importing the estimate code
+HEAVY = ['matplotlib', 'uproot', 'coffea', 'bucoffea', 'scipy']
+
+# Modules checked by default, also by tests/test_importtime.py
+MODULES = ['fitlib', 'storelib', 'templatelib', 'ingestlib', 'loaderlib', 'binninglib', 'data_driven_qcd']
+BUDGET_MS = 300
+
+def import_times(module):
+    '''
+    Runs python -X importtime on a module.
+
+    Returns a dict mapping every imported module to its cumulative import time in microseconds.
+    '''
+    proc = subprocess.run(
+                        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        stderr=subprocess.PIPE,
+                        universal_newlines=True,
+                        check=True
+                        )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def problems(module, budget_ms=BUDGET_MS):
+    '''
+    Import time of a module in ms and the list of its violations of the budget.
+    '''
+    times = import_times(module)
+    ret = []
+    total = times[module] / 1e3
+    if total > budget_ms:
+        ret.append(f"{module}: import takes {total:.1f} ms, budget is {budget_ms} ms")
+    heavy = sorted(name for name in times if name.split('.')[0] in HEAVY)
+    if heavy:
+        ret.append(f"{module}: imports heavy modules {heavy}")
+    return total, ret
+
+def check(module, budget_ms):
+    total, found = problems(module, budget_ms)
+    for problem in found:
+        print(problem)
+    if not found:
+        print(f"{module}: {total:.1f} ms")
+    return not found
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the import time of the estimate modules against a budget.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS, help='Maximum cumulative import time per module.')
+    args = parser.parse_args()
+
+    ok = all([check(module, args.budget_ms) for module in args.modules])
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+
+from templatelib import GROUPS
+
+pjoin = os.path.join
+
+DEFAULT_CONFIG = pjoin(os.path.dirname(os.path.abspath(__file__)), "config", "qcd_estimate.yaml")
+
+# Recoil binning search, see the optimize stage
+OPTIMIZE = dict(min_neff=[10, 20, 50, 100, 200, 500], max_rel_unc=[0.05, 0.1, 0.2, 0.3, 0.5], chunks=4)
+
+REQUIRED = ['indir', 'distribution', 'years', 'regions', 'dphi_cut', 'closure_cuts', 'fit', 'bins']
+
+def load_config(path=DEFAULT_CONFIG):
+    '''
+    Reads the job matrix from a YAML or TOML file.
+    '''
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            # The toml package reads text, tomllib binary files
+            import toml
+            with open(path) as f:
+                config = toml.load(f)
+        else:
+            with open(path, "rb") as f:
+                config = tomllib.load(f)
+    else:
+        import yaml
+        with open(path) as f:
+            config = yaml.safe_load(f)
+
+    missing = [key for key in REQUIRED if key not in config]
+    if missing:
+        raise ValueError(f"Config {path} is missing the keys {missing}")
+    for region in config['regions']:
+        if region not in config['bins']:
+            raise ValueError(f"Config {path} has no binnings for region {region}")
+
+    if not config.get('outdir'):
+        config['outdir'] = pjoin('./output/', config['indir'].rstrip('/').split('/')[-1])
+    config.setdefault('groups', GROUPS)
+    missing = [name for name in GROUPS if name not in config['groups']]
+    if missing:
+        raise ValueError(f"Config {path} is missing the dataset groups {missing}")
+    config.setdefault('stages', ['templates', 'fit', 'store', 'variations', 'prediction'])
+    # Keys missing from the optimize section keep their defaults
+    config['optimize'] = dict(OPTIMIZE, **(config.get('optimize') or {}))
+    return config
@@ -1,18 +1,29 @@
 #!/usr/bin/env python
+import argparse
+import fnmatch
 import os
-import pickle
 import re
 from collections import defaultdict
+from functools import partial
 
 import numpy as np
-import uproot
-from bucoffea.plot.util import (URTH1, fig_ratio, klepto_load, merge_datasets,
-                                merge_extensions, scale_xs_lumi)
-from coffea import hist
-from coffea.hist.export import export1d
-from matplotlib import pyplot as plt
 
-from fitlib import TFFit
+from binninglib import fine_edges, greedy_binning, pareto_front
+from cachelib import cached_distribution
+from configlib import DEFAULT_CONFIG, load_config
+from fitlib import BatchTFFit, TFFit, exponential, exponential2, get_model
+from ingestlib import stream_tensor
+from loaderlib import load, warm_store
+from pipelinelib import Job, Shared, run_jobs, select_jobs, shard_jobs, share
+from plotlib import configure, fig_ratio, render_queue
+from plotlib import enabled as plots_enabled
+from storelib import (PredictionWriter, TemplateStore, atomic_save,
+                      export_templates_root, fit_record, merge_fit_stores,
+                      merge_template_stores, read_records, template_record,
+                      write_fit_store, write_template_store)
+from templatelib import QCDTensor, hist_index, slice_indices
+from tracelib import configure as configure_trace
+from tracelib import span, summarize, to_chrome
 
 colors = [
  'crimson',
@@ -21,20 +32,6 @@ colors = [
  'purple'
 ]
 
-def exponential(x,a,b,c):
-    ret = a * np.exp(-b*x) + c
-    ret[ret<0] = 0
-    return ret
-
-def exponential2(x,a,b,c,d):
-    ret = a * np.exp(-b*x -c*x**2) + d
-    ret[ret<0] = 0
-    return ret
-
-from bucoffea.plot.style import matplotlib_rc
-
-matplotlib_rc()
-
 def ratio_unc(num, denom, dnum, ddenom):
     return np.hypot(
         dnum * (1/denom),
@@ -53,90 +50,105 @@ def dd():
     return defaultdict(dict)
 
 
-def make_templates(acc, outdir, tag, bins, region, dphi_cr=slice(0.0,0.5), dphi_sr=slice(0.5,None)):
+def make_templates(templates, outdir, tag, bins, region, year, dphi_cr=slice(0.0,0.5), dphi_sr=slice(0.5,None)):
     '''
     Creates the input templates for the fits.
 
-    We start with a 2D distribution of recoil vs delta phi, which is just a coffea histogram.
-    Then, we integrate dphi slices and different dataset combinations to get QCD MC, non-QCD MC and data
-    in all the relevant regions.
+    We start with a 2D distribution of recoil vs delta phi, which has been converted
+    into a dense QCDTensor once. Then, we integrate dphi slices for the QCD MC,
+    non-QCD MC and data groups in all the relevant regions.
     '''
-    distribution = "recoil_vs_dphi_qcd"
-
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-    
+    os.makedirs(outdir, exist_ok=True)
 
-    parameters = defaultdict(dd)
-    f = uproot.recreate(pjoin(outdir, f"templates_{region}_{tag}.root"))
-    for year in [2017,2018]:
-        # REBINNED
-        h = acc[distribution].integrate("region", region)
-        h=h.rebin("recoil", hist.Bin('recoil','Recoil (GeV)', bins))
-        histos = {}
-        histos["qcd"]    = h[re.compile(f"QCD.*HT.*{year}")].integrate("dataset")
-        histos["nonqcd"] = h[re.compile(f'(ZJetsToNuNu.*|Top_FXFX.*|Diboson.*|.*DYJetsToLL_M-50_HT_MLM.*|.*WJetsToLNu.*HT.*).*{year}')].integrate("dataset")
-        histos["data"]   = h[re.compile(f"MET_{year}")].integrate("dataset")
-
-        sr_sumw = {}
-        sr_sumw2 = {}
-        cr_sumw = {}
-        cr_sumw2 = {}
-
-
-        for name in ["qcd","nonqcd","data"]:
-            sr_sumw[name],sr_sumw2[name] = histos[name].integrate("dphi",dphi_sr).values(sumw2=True,overflow="none")[()]
-            cr_sumw[name],cr_sumw2[name] = histos[name].integrate("dphi",dphi_cr).values(sumw2=True,overflow="none")[()]
-        
-        tf = sr_sumw["qcd"]/cr_sumw["qcd"]
-        dtf = ratio_unc(sr_sumw["qcd"], cr_sumw["qcd"], np.sqrt(sr_sumw2["qcd"]), np.sqrt(cr_sumw2["qcd"]))
-
-        for name in ["qcd","nonqcd","data"]:
-            f[f"{region}_{year}_cr_{name}"] = export1d(histos[name].integrate("dphi",dphi_cr))
-            f[f"{region}_{year}_sr_{name}"] = export1d(histos[name].integrate("dphi",dphi_sr))
-        f[f"{region}_{year}_tf"] = URTH1(
-                    edges=histos["qcd"].axis("recoil").edges(),
-                    sumw=np.r_[0,tf,0],
-                    sumw2=np.r_[0,dtf**2,0]
-                    )
+    histos = templates.templates(region, year, bins, dphi_cr=dphi_cr, dphi_sr=dphi_sr)
 
-def fit_tf(outdir, tag, region):
-    '''
-    Consume the input templates, make TFs and fit them.
-    '''
-    f = uproot.open(pjoin(outdir, f"templates_{region}_{tag}.root"))
+    # Underflow and overflow are not part of the TF
+    sr_sumw, sr_sumw2 = [x[1:-1] for x in histos[("sr","qcd")]]
+    cr_sumw, cr_sumw2 = [x[1:-1] for x in histos[("cr","qcd")]]
 
+    tf = sr_sumw/cr_sumw
+    dtf = ratio_unc(sr_sumw, cr_sumw, np.sqrt(sr_sumw2), np.sqrt(cr_sumw2))
 
-    fits = {}
-    for year in [2017,2018]:
-        print("Fit",tag, year)
-        h = f[f'{region}_{year}_tf']
+    records = []
+    for (selection, name), (sumw, sumw2) in histos.items():
+        records.append(template_record(tag, year, f"{region}_{year}_{selection}_{name}", bins, sumw, sumw2))
+    records.append(template_record(tag, year, f"{region}_{year}_tf", bins, np.r_[0,tf,0], np.r_[0,dtf**2,0]))
 
-        tf = h.allvalues[1:]
-        dtf = np.sqrt(h.allvariances[1:])
+    write_template_store(pjoin(outdir, f"templates_{region}_{tag}_{year}.npy"), records)
 
-        for i in range(len(dtf)):
-            if dtf[i] == 0:
-                dtf[i] = dtf[i-1]
-                print(i, dtf[i])
-        bins = h.allbins[1:]
-        bins[-1,1] = bins[-1,0] + bins[-2,1] - bins[-2,0]
-        dx = 0.5*np.diff(bins   , axis=1)[:,0]
-        x  = 0.5*np.sum(bins, axis=1)
+def fit_tf(outdir, tag, region, year, fun=exponential, p0=(0.5,1e-2,0), ntoys=0, toy_seed=None, warm_start=False, baseline=False):
+    '''
+    Consume the input templates, make TFs and fit them.
 
-        
-        guess = [0.5,1e-2,0]
-        fits[year] = TFFit(
+    If ntoys is given, the fits are repeated on fluctuated toy TFs
+    for the alternative fit uncertainty. With warm_start, the fit starts
+    from the model's guess for the TF points. If there is none or the fit
+    diverges from there, the default p0 is used. With baseline, the fit is
+    also run from p0 to measure the evaluations a warm start saves, and the
+    better of the two minima is kept.
+    '''
+    f = TemplateStore(pjoin(outdir, f"templates_{region}_{tag}_{year}.npy")).view(tag)
+
+    print("Fit",tag, year)
+    h = f[f'{region}_{year}_tf']
+
+    tf = h.allvalues[1:]
+    dtf = np.sqrt(h.allvariances[1:])
+
+    for i in range(len(dtf)):
+        if dtf[i] == 0:
+            dtf[i] = dtf[i-1]
+            print(i, dtf[i])
+    bins = h.allbins[1:]
+    bins[-1,1] = bins[-1,0] + bins[-2,1] - bins[-2,0]
+    dx = 0.5*np.diff(bins   , axis=1)[:,0]
+    x  = 0.5*np.sum(bins, axis=1)
+
+
+    fit = None
+    nfev = 0
+    model = get_model(fun)
+    guess = model.guess(x, tf, dtf) if warm_start and model is not None and model.guess else None
+    if guess is not None:
+        fit = TFFit(x=x, y=tf, dy=dtf, fun=fun, p0=list(guess))
+        fit.start = 'guess'
+        try:
+            fit.fit()
+            diverged = not (np.isfinite(fit.chi2) and np.all(np.isfinite(fit.pcov)))
+        except RuntimeError:
+            diverged = True
+        if diverged:
+            print(f"Warm start diverged for {tag} {year}, using the default guess")
+            nfev = getattr(fit, 'nfev', 0)
+            fit = None
+
+    if fit is None or baseline:
+        cold = TFFit(
             x=x,
             y=tf,
             dy=dtf,
-            fun=exponential,
-            p0=guess
+            fun=fun,
+            p0=list(p0)
 
         )
-        
-        # Plot results
-        fits[year].fit()
+        cold.fit()
+        if fit is None:
+            # Evaluations of a failed warm start count as well
+            cold.nfev += nfev
+            fit = cold
+        else:
+            fit.nfev_p0 = cold.nfev
+            if cold.chi2 < fit.chi2 - 1e-6 * max(fit.chi2, 1):
+                print(f"Warm start ended in a worse minimum for {tag} {year}, using the fit from the default guess")
+                cold.nfev += fit.nfev
+                cold.nfev_p0 = fit.nfev_p0
+                fit = cold
+    
+    if ntoys:
+        fit.fit_toys(ntoys, seed=None if toy_seed is None else [toy_seed, year])
+
+    # Plot results
+    if plots_enabled():
         fig, ax, rax = fig_ratio()
         ax.errorbar(
                     x,
@@ -147,9 +159,9 @@ def fit_tf(outdir, tag, region):
                     label="Coarse-binned histogram",
                     color="k"
                     )
-        
+    
         xinterp = np.linspace(150, max(x), 100)
-        nominal = fits[year].evaluate(xinterp, "best")
+        nominal = fit.evaluate(xinterp, "best")
         ax.plot(
             xinterp,
             nominal,
@@ -158,13 +170,13 @@ def fit_tf(outdir, tag, region):
         )
         rax.errorbar(
             x,
-            tf / fits[year].evaluate(x, "best"),
-            dtf / fits[year].evaluate(x, "best"),
+            tf / fit.evaluate(x, "best"),
+            dtf / fit.evaluate(x, "best"),
             fmt="o",
             color="k"
         )
 
-        variations = fits[year].evaluate_all(xinterp)
+        variations = fit.evaluate_all(xinterp)
         i = 0
         for var in set([re.sub("_(up|dn)","", x) for x in variations.keys()]):
             if 'best' in var:
@@ -199,27 +211,28 @@ def fit_tf(outdir, tag, region):
         ax.set_ylim(1e-5,1e0)
         ax.set_title(f"{tag}, {year}")
         fig.savefig(pjoin(outdir,f"tf_fit_{region}_{tag}_{year}.pdf"),bbox_inches='tight')
-        plt.close(fig)
 
-    with open(pjoin(outdir, f"tf_fit_{region}_{tag}.pkl"),"wb") as f:
-        pickle.dump(fits, f)
+    write_fit_store(
+                    pjoin(outdir, f"tf_fit_{region}_{tag}_{year}.npy"),
+                    [fit_record(year, tag, fit)]
+                    )
 
 
 
-def tf_variations(outdir, region):
+def store_inputs(outdir, region):
+    '''
+    The (kind, path) of the fit and template stores of a region.
+    '''
+    return [('fits', pjoin(outdir, f"tf_fits_{region}.npy")), ('templates', pjoin(outdir, f"templates_{region}.npy"))]
+
+def tf_variations(outdir, region, years=(2017,2018)):
     '''
     Nice plots of fit variations.
     '''
     x = np.linspace(250,1400,100)
-    for year in [2017,2018]:
-        fits = {}
-        for file in  os.listdir(outdir):
-            m = re.match(f"tf_fit_{region}_nominal_bin_([a-z,0-9]*).pkl",file)
-            if not m:
-                continue
-            bintag = m.groups()[0]
-            with open(pjoin(outdir, file),"rb") as f:
-                fits[bintag] = pickle.load(f)[year]
+    store = load('fits', pjoin(outdir, f"tf_fits_{region}.npy"))
+    for year in years:
+        fits = store.fits(year, "nominal")
 
         fig, ax, rax = fig_ratio()
         nominal = fits['nom'].evaluate(x,"best")
@@ -258,7 +271,6 @@ def tf_variations(outdir, region):
         ax.set_title(f"{year}")
         rax.legend()
         fig.savefig(pjoin(outdir,f"tf_variations_{region}_{year}.pdf"),bbox_inches='tight')
-        plt.close(fig)
 
 def histdiff(h1, h2):
     sumw = h1.allvalues - h2.allvalues
@@ -266,30 +278,23 @@ def histdiff(h1, h2):
     return sumw, sumw2
     
 
-def tf_closure(outdir, region):
+def tf_closure(outdir, region, years=(2017,2018), cuts=(0.2,0.3,0.4)):
     '''
     Consumes the TFs and creates validation plots.
     '''
     x = np.linspace(250,1400,100)
 
     plotdir = pjoin(outdir, "closure")
-    if not os.path.exists(plotdir):
-        os.makedirs(plotdir)
-    for year in [2017,2018]:
-        for cut in [0.2,0.3,0.4]:
+    os.makedirs(plotdir, exist_ok=True)
+    store, templates = [load(*x) for x in store_inputs(outdir, region)]
+    for year in years:
+        for cut in cuts:
             tag = f"closure_{cut}".replace('.','p')
 
             # Load fits
-            fits = {}
-            for file in  os.listdir(outdir):
-                m = re.match(f"tf_fit_{region}_{tag}_bin_([a-z,0-9]*).pkl",file)
-                if not m:
-                    continue
-                bintag = m.groups()[0]
-                with open(pjoin(outdir, file),"rb") as f:
-                    fits[bintag] = pickle.load(f)[year]
+            fits = store.fits(year, tag)
             # Load templates
-            f = uproot.open(pjoin(outdir,f"templates_{region}_{tag}_bin_nom.root"))
+            f = templates.view(f"{tag}_bin_nom")
             
             cr_qcd_sumw, cr_qcd_sumw2 = histdiff(f[f"{region}_{year}_cr_data"], f[f"{region}_{year}_cr_nonqcd"])
             sr_qcd_sumw, sr_qcd_sumw2 = histdiff(f[f"{region}_{year}_sr_data"], f[f"{region}_{year}_sr_nonqcd"])
@@ -395,32 +400,273 @@ def tf_closure(outdir, region):
             # ax.set_title(f"{year}")
             # rax.legend()
             fig.savefig(pjoin(plotdir,f"tf_closure_{region}_{tag}_{year}.png"),bbox_inches='tight')
-            plt.close(fig)
 
-def tf_prediction(outdir,region):
+def scan_tf(cr_sumw, cr_sumw2, sr_sumw, sr_sumw2, bins):
+    '''
+    TF points of QCD templates from QCDTensor.scan, one row per cut.
+
+    Same points as in fit_tf: the bins and the overflow as one more bin of the same width.
+    Returns x, tf, dtf and the mask of usable points.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tf = sr_sumw[:, 1:-1] / cr_sumw[:, 1:-1]
+        dtf = ratio_unc(sr_sumw[:, 1:-1], cr_sumw[:, 1:-1], np.sqrt(sr_sumw2[:, 1:-1]), np.sqrt(cr_sumw2[:, 1:-1]))
+    tf = np.c_[tf, np.zeros(len(tf))]
+    dtf = np.c_[dtf, np.zeros(len(dtf))]
+    for i in range(dtf.shape[1]):
+        dtf[:, i] = np.where(dtf[:, i] == 0, dtf[:, i-1], dtf[:, i])
+    edges = np.r_[bins, 2*bins[-1] - bins[-2]]
+    x = 0.5*(edges[1:] + edges[:-1])
+
+    mask = np.isfinite(tf) & np.isfinite(dtf) & (dtf > 0)
+    return x, np.where(mask, tf, 0), np.where(mask, dtf, 0), mask
+
+def scan_closure(groups, cr_sumw, cr_sumw2, sr_sumw, sr_sumw2, prediction_tf):
+    '''
+    Per-bin SR closure of scan templates for TFs evaluated at the bin centers.
+
+    Every SR bin of data - non-QCD and of QCD MC is compared to its prediction
+    from the CR, with the statistical uncertainties of SR and CR. Returns the
+    chi2 of data - non-QCD, the number of bins entering it, its largest pull
+    in a single bin and the chi2 of QCD MC, one value per cut.
+    '''
+    iqcd, inonqcd, idata = [groups.index(x) for x in ['qcd', 'nonqcd', 'data']]
+    def pulls(sr, sr2, cr, cr2):
+        var = sr2 + prediction_tf**2 * cr2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(var > 0, (sr - prediction_tf * cr) / np.sqrt(var), 0), var > 0
+    pull, used = pulls(
+                    sr_sumw[:, idata, 1:-1] - sr_sumw[:, inonqcd, 1:-1],
+                    sr_sumw2[:, idata, 1:-1] + sr_sumw2[:, inonqcd, 1:-1],
+                    cr_sumw[:, idata, 1:-1] - cr_sumw[:, inonqcd, 1:-1],
+                    cr_sumw2[:, idata, 1:-1] + cr_sumw2[:, inonqcd, 1:-1],
+                    )
+    pull_mc, _ = pulls(sr_sumw[:, iqcd, 1:-1], sr_sumw2[:, iqcd, 1:-1], cr_sumw[:, iqcd, 1:-1], cr_sumw2[:, iqcd, 1:-1])
+    return np.sum(pull**2, axis=1), used.sum(axis=1), np.max(np.abs(pull), axis=1, initial=0), np.sum(pull_mc**2, axis=1)
+
+def dphi_scan(templates, outdir, region, year, binnings, dphi_cut=0.5, fun=exponential, p0=(0.5,1e-2,0)):
+    '''
+    Closure test for every fine dphi edge below dphi_cut as CR/SR boundary.
+
+    All templates come from the cumulative dphi sums, all TFs of a binning
+    are fitted together, starting from the results of the previous binning.
+    Writes one summary row per binning and cut with the fit parameters and
+    the per-bin closure in the SR.
+    '''
+    model = get_model(fun)
+
+    # Every edge that leaves at least one dphi bin on both sides
+    _, stop = slice_indices(templates.dphi_edges, slice(None, dphi_cut))
+    cuts = templates.dphi_edges[1:stop-1]
+    iqcd = templates.groups.index('qcd')
+
+    rows = []
+    previous = None
+    for bintag, bins in binnings.items():
+        cr_sumw, cr_sumw2, sr_sumw, sr_sumw2 = templates.scan(region, year, bins, cuts, dphi_cut=dphi_cut)
+        x, tf, dtf, mask = scan_tf(cr_sumw[:, iqcd], cr_sumw2[:, iqcd], sr_sumw[:, iqcd], sr_sumw2[:, iqcd], bins)
+
+        # Start from the converged results of the previous binning for the same cut
+        start = np.broadcast_to(np.asarray(p0, dtype=float), (len(cuts), model.npar))
+        warm = np.zeros(len(cuts), dtype=bool)
+        if previous is not None:
+            warm = previous.converged
+            start = np.where(warm[:, None], previous.pars['best'], start)
+        fit = BatchTFFit(x, tf, dtf, fun, p0=start, mask=mask)
+        fit.fit()
+
+        # Fall back to the default guess where the warm start did not converge
+        retry = warm & ~fit.converged
+        if np.any(retry):
+            refit = BatchTFFit(x, tf[retry], dtf[retry], fun, p0=p0, mask=mask[retry])
+            refit.fit()
+            for key in fit.pars:
+                fit.pars[key][retry] = refit.pars[key]
+            fit.pcov[retry] = refit.pcov
+            fit.chi2[retry] = refit.chi2
+            fit.converged[retry] = refit.converged
+            fit.niter[retry] += refit.niter
+        previous = fit
+        prediction_tf = fun(x[None, :-1], *fit.pars['best'].T[..., None])
+        closure_chi2, closure_ndf, closure_pull, closure_mc_chi2 = scan_closure(templates.groups, cr_sumw, cr_sumw2, sr_sumw, sr_sumw2, prediction_tf)
+
+        for i, cut in enumerate(cuts):
+            rows.append((
+                region,
+                year,
+                bintag,
+                cut,
+                fit.converged[i],
+                fit.chi2[i],
+                fit.mask[i].sum() - model.npar,
+                fit.niter[i],
+                fit.pars['best'][i],
+                np.sqrt(np.diag(fit.pcov[i])),
+                closure_chi2[i],
+                closure_ndf[i],
+                closure_pull[i],
+                closure_mc_chi2[i],
+            ))
+
+    dtype = [
+        ('region', 'U64'),
+        ('year', 'i4'),
+        ('bintag', 'U64'),
+        ('cut', 'f8'),
+        ('converged', '?'),
+        ('chi2', 'f8'),
+        ('ndf', 'i4'),
+        ('niter', 'i4'),
+        ('parameters', 'f8', (model.npar,)),
+        ('uncertainties', 'f8', (model.npar,)),
+        ('closure_chi2', 'f8'),
+        ('closure_ndf', 'i4'),
+        ('closure_pull', 'f8'),
+        ('closure_mc_chi2', 'f8'),
+    ]
+    atomic_save(pjoin(outdir, f"dphi_scan_{region}_{year}.npy"), np.array(rows, dtype=dtype))
+
+def optimize_binning(templates, outdir, region, year, chunk, grid, recoil_range, dphi_cut=0.5, closure_cuts=(0.2,0.3,0.4), fun=exponential, p0=(0.5,1e-2,0)):
+    '''
+    Evaluates candidate recoil binnings built from the fine recoil axis.
+
+    Every (min_neff, max_rel_unc) pair in grid gives one candidate from the
+    nominal QCD MC templates. Candidates are rebins of the dense templates,
+    the nominal TFs and the TFs of all closure cuts of all candidates are
+    fitted in a single batch. Writes one row per candidate with the chi2 of
+    the nominal fit and the per-bin closure of the closure cuts.
+    '''
+    model = get_model(fun)
+    iqcd = templates.groups.index('qcd')
+    edges = fine_edges(templates.recoil_edges, *recoil_range)
+    cuts = sorted(closure_cuts)
+
+    # Fine nominal QCD MC templates, without the flow bins
+    fine = templates.scan(region, year, edges, [dphi_cut], dphi_cut=None)
+    fine = [x[0, iqcd, 1:-1] for x in fine]
+
+    candidates = {}
+    for min_neff, max_rel_unc in grid:
+        bins = greedy_binning(edges, *fine, min_neff, max_rel_unc)
+        # len(bins)-1 bins and the overflow are fitted, leaving at least one degree of freedom
+        if len(bins) > model.npar:
+            candidates.setdefault(tuple(bins), (min_neff, max_rel_unc))
+
+    # One nominal and one row per closure cut for every candidate, padded to the finest binning
+    nrow = 1 + len(cuts)
+    shape = (len(candidates), nrow, len(edges))
+    x, tf, dtf = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    mask = np.zeros(shape, dtype=bool)
+    closure_templates = []
+    for i, bins in enumerate(candidates):
+        bins = np.array(bins)
+        nominal = templates.scan(region, year, bins, [dphi_cut], dphi_cut=None)
+        closure = templates.scan(region, year, bins, cuts, dphi_cut=dphi_cut)
+        parts = [np.concatenate(pair) for pair in zip(nominal, closure)]
+        xi, tfi, dtfi, maski = scan_tf(*[part[:, iqcd] for part in parts], bins)
+        n = len(xi)
+        x[i, :, :n], tf[i, :, :n], dtf[i, :, :n], mask[i, :, :n] = xi, tfi, dtfi, maski
+        closure_templates.append(closure)
+
+    rows = []
+    if candidates:
+        fit = BatchTFFit(x.reshape(-1, len(edges)), tf.reshape(-1, len(edges)), dtf.reshape(-1, len(edges)), fun, p0=p0, mask=mask.reshape(-1, len(edges)))
+        fit.fit()
+        best = fit.pars['best'].reshape(len(candidates), nrow, model.npar)
+        chi2 = fit.chi2.reshape(len(candidates), nrow)
+        converged = fit.converged.reshape(len(candidates), nrow)
+        for i, (bins, (min_neff, max_rel_unc)) in enumerate(candidates.items()):
+            nbins = len(bins) - 1
+            prediction_tf = fun(x[i, 0, None, :nbins], *best[i, 1:].T[..., None])
+            closure_chi2, closure_ndf, closure_pull, closure_mc_chi2 = scan_closure(templates.groups, *closure_templates[i], prediction_tf)
+            padded = np.full(len(edges), np.nan)
+            padded[:len(bins)] = bins
+            rows.append((
+                region,
+                year,
+                min_neff,
+                max_rel_unc,
+                nbins,
+                padded,
+                np.all(converged[i]),
+                chi2[i, 0],
+                mask[i, 0].sum() - model.npar,
+                closure_chi2,
+                closure_ndf,
+                closure_pull,
+                closure_mc_chi2,
+                np.max(closure_chi2 / np.maximum(closure_ndf, 1)) if len(cuts) else 0.,
+                False,
+            ))
+
+    dtype = [
+        ('region', 'U64'),
+        ('year', 'i4'),
+        ('min_neff', 'f8'),
+        ('max_rel_unc', 'f8'),
+        ('nbins', 'i4'),
+        ('bins', 'f8', (len(edges),)),
+        ('converged', '?'),
+        ('chi2', 'f8'),
+        ('ndf', 'i4'),
+        ('closure_chi2', 'f8', (len(cuts),)),
+        ('closure_ndf', 'i4', (len(cuts),)),
+        ('closure_pull', 'f8', (len(cuts),)),
+        ('closure_mc_chi2', 'f8', (len(cuts),)),
+        ('nonclosure', 'f8'),
+        ('pareto', '?'),
+    ]
+    atomic_save(pjoin(outdir, f"binning_candidates_{region}_{year}_{chunk}.npy"), np.array(rows, dtype=dtype))
+
+def binning_front(outdir, region, year, paths):
+    '''
+    Combines the candidate binnings of all chunks and marks the Pareto-optimal ones.
+
+    The objectives are the chi2/ndf of the nominal fit, the largest closure
+    chi2/ndf over the closure cuts and the number of bins, of which more is better.
+    '''
+    table = np.concatenate([np.load(path) for path in paths])
+
+    # Candidates found by several chunks are kept once
+    if len(table):
+        _, first = np.unique(np.nan_to_num(table['bins'], nan=-1), axis=0, return_index=True)
+        table = table[np.sort(first)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        objectives = np.c_[table['chi2'] / table['ndf'], table['nonclosure'], -table['nbins']]
+    valid = table['converged'] & (table['ndf'] > 0) & np.all(np.isfinite(objectives), axis=1)
+    table['pareto'][valid] = pareto_front(objectives[valid])
+    atomic_save(pjoin(outdir, f"binning_optimization_{region}_{year}.npy"), table)
+
+    for row in np.sort(table[table['pareto']], order='nbins'):
+        bins = row['bins'][:row['nbins']+1]
+        print(f"Pareto-optimal binning for {region} {year}: {row['nbins']} bins, chi2/ndf {row['chi2']/row['ndf']:.2f}, "
+              f"closure chi2/ndf {row['nonclosure']:.2f}: [{', '.join(f'{x:g}' for x in bins)}]")
+
+def tf_prediction(outdir,region, years=(2017,2018), fit_unc='eigen'):
     '''
     Consumes the fitted TFs and creates the final BG prediction.
+
+    The fit uncertainty is either the eigenvector envelope ("eigen")
+    or the percentile band of the toy fits ("toys"). The shapes are
+    collected in prediction_{region}.npy, write_prediction combines
+    all regions into the ROOT file.
     '''
     x = np.linspace(250,1400,100)
 
     plotdir = pjoin(outdir, "prediction")
-    if not os.path.exists(plotdir):
-        os.makedirs(plotdir)
+    if plots_enabled():
+        os.makedirs(plotdir, exist_ok=True)
 
-    fout = uproot.recreate(f"qcdestimate_{region}.root")
-    for year in [2017,2018]:
+    store, templates = [load(*x) for x in store_inputs(outdir, region)]
+    channel = 'monojet' if '_j' in region else 'monov'
+    records = []
+    for year in years:
 
         # Load fits
-        fits = {}
-        for file in  os.listdir(outdir):
-            m = re.match(f"tf_fit_{region}_nominal_bin_([a-z,0-9]*).pkl",file)
-            if not m:
-                continue
-            bintag = m.groups()[0]
-            with open(pjoin(outdir, file),"rb") as f:
-                fits[bintag] = pickle.load(f)[year]
+        fits = store.fits(year, "nominal")
         # Load templates
-        f = uproot.open(pjoin(outdir,f"templates_{region}_nominal_bin_nom.root"))
+        f = templates.view("nominal_bin_nom")
         
         cr_qcd_sumw, cr_qcd_sumw2 = histdiff(f[f"{region}_{year}_cr_data"], f[f"{region}_{year}_cr_nonqcd"])
 
@@ -440,13 +686,20 @@ def tf_prediction(outdir,region):
         nominal_sumw2 = fits['nom'].evaluate(x,"best") * cr_qcd_sumw2[1:]
 
         mask = bins[:,0] >= 250
+        # All shapes of this year share the binning
+        edges = np.unique(bins[mask][:-1])
+        def shape(name, sumw, sumw2=None):
+            records.append(template_record(
+                            "prediction",
+                            year,
+                            name,
+                            edges,
+                            np.r_[0,sumw[mask]],
+                            np.r_[0,sumw2[mask]] if sumw2 is not None else np.zeros(len(edges)+1)
+                            ))
+
         # Save nominal to file
-        channel = 'monojet' if '_j' in region else 'monov'
-        fout[f'qcd_{channel}_{year}'] = URTH1(
-            edges=np.unique(bins[mask][:-1]),
-            sumw=np.r_[0,nominal[mask]],
-            sumw2=np.r_[0,nominal_sumw2[mask]],
-        )
+        shape(f'qcd_{channel}_{year}', nominal, nominal_sumw2)
 
         # Plot QCD MC
         ax.errorbar(
@@ -473,16 +726,8 @@ def tf_prediction(outdir,region):
                     label='Binning uncertainty'
                     )
             # Write binning variations to file
-            fout[f'qcd_{channel}_{year}_qcdbinning_{channel}_{year}Up'] = URTH1(
-                edges=np.unique(bins[mask][:-1]),
-                sumw=np.r_[0,varied[mask]],
-                sumw2=np.r_[0,np.zeros(len(varied[mask]))],
-            )
-            fout[f'qcd_{channel}_{year}_qcdbinning_{channel}_{year}Down'] = URTH1(
-                edges=np.unique(bins[mask][:-1]),
-                sumw=np.r_[0,(2*nominal-varied)[mask]],
-                sumw2=np.r_[0,np.zeros(len(varied[mask]))],
-            )
+            shape(f'qcd_{channel}_{year}_qcdbinning_{channel}_{year}Up', varied)
+            shape(f'qcd_{channel}_{year}_qcdbinning_{channel}_{year}Down', 2*nominal-varied)
 
         ax.fill_between(
                     x,
@@ -494,19 +739,14 @@ def tf_prediction(outdir,region):
                     label='Closure uncertainty'
                     )
 
-        env_dn, env_up = fits['nom'].envelope(x)  * cr_qcd_sumw[1:]
+        if fit_unc == 'toys':
+            env_dn, env_up = fits['nom'].toy_envelope(x)  * cr_qcd_sumw[1:]
+        else:
+            env_dn, env_up = fits['nom'].envelope(x)  * cr_qcd_sumw[1:]
 
         # Write fit variation envelopes to file
-        fout[f'qcd_{channel}_{year}_qcdfit_{channel}_{year}Up'] = URTH1(
-                edges=np.unique(bins[mask][:-1]),
-                sumw=np.r_[0,env_up[mask]],
-                sumw2=np.r_[0,np.zeros(len(env_up[mask]))],
-            )
-        fout[f'qcd_{channel}_{year}_qcdfit_{channel}_{year}Down'] = URTH1(
-                edges=np.unique(bins[mask][:-1]),
-                sumw=np.r_[0,env_dn[mask]],
-                sumw2=np.r_[0,np.zeros(len(env_up[mask]))],
-            )
+        shape(f'qcd_{channel}_{year}_qcdfit_{channel}_{year}Up', env_up)
+        shape(f'qcd_{channel}_{year}_qcdfit_{channel}_{year}Down', env_dn)
         ax.plot(
             x,
             nominal,
@@ -565,83 +805,410 @@ def tf_prediction(outdir,region):
         ax.set_yscale("log")
         ax.set_ylim(1e-4,1e8)
         fig.savefig(pjoin(plotdir,f"tf_prediction_{region}_{year}.pdf"),bbox_inches='tight')
-        plt.close(fig)
+    write_template_store(pjoin(outdir, f"prediction_{region}.npy"), records)
+
+def write_prediction(outdir, regions, filename="qcdestimate.root"):
+    '''
+    Writes the predictions of all regions into a single ROOT file in one pass,
+    one directory per region with the shapes named as in the per-region files.
+    '''
+    writer = PredictionWriter()
+    for region in regions:
+        path = pjoin(outdir, f"prediction_{region}.npy")
+        if not os.path.exists(path):
+            print(f"No prediction for region {region}, it is missing in {filename}")
+            continue
+        writer.add_store(path, directory=region)
+    writer.write(pjoin(outdir, filename))
+
+def warm_start_report(paths):
+    '''
+    Compares the function evaluations of warm-started fits to those of the same
+    fits from the default guess, measured for the baseline sample of fits.
+    '''
+    records = []
+    for path in paths:
+        if os.path.exists(path):
+            records += read_records(path)
+    warm = [r['nfev'] for r in records if r['start']]
+    sample = [r for r in records if r['nfev_p0']]
+    if not warm or not sample:
+        return
+    nfev = np.sum([r['nfev'] for r in sample])
+    nfev_p0 = np.sum([r['nfev_p0'] for r in sample])
+    print(f"Warm starts: {len(warm)} of {len(records)} fits, {np.mean(warm):.1f} evaluations on average")
+    print(f"Baseline of {len(sample)} fits: {nfev} evaluations, {nfev_p0} from p0 ({1 - nfev/nfev_p0:.0%} saved)")
+    expected = len(records) * nfev_p0 / len(sample)
+    saved = expected - np.sum([r['nfev'] for r in records])
+    print(f"Warm starts saved about {saved:.0f} of {expected:.0f} evaluations ({saved/expected:.0%}), extrapolated from the baseline")
+
+def load_distribution(indir, distribution, reweight_pu):
+    '''
+    Loads a distribution from the klepto archive, merges extensions and datasets and
+    scales to cross section and luminosity.
+    '''
+    from bucoffea.plot.util import (klepto_load, merge_datasets,
+                                    merge_extensions, scale_xs_lumi)
 
-def main():
-    # Input handling
-    indir = "./input/2020-05-28_qcd_estimate_v5"
     acc = klepto_load(indir)
     acc.load('sumw')
     acc.load('sumw_pileup')
     acc.load('nevents')
-    distributions = ["recoil_vs_dphi_qcd"]
-
-    # Merging, scale, etc
-    for distribution in distributions:
-        acc.load(distribution)
-        acc[distribution] = merge_extensions(acc[distribution], acc, reweight_pu=not ('nopu' in distribution))
-        scale_xs_lumi(acc[distribution])
-        acc[distribution] = merge_datasets(acc[distribution])
-        acc[distribution].axis('dataset').sorting = 'integral'
-
-    # Alternative binnings
-    # split by the name of the signal region to be estimated
-    bins = { 
-        'cr_qcd_j': {
-
-            'nom' :  [ 180,200,220,250,  280,  310,  340,  370,  400,  430,  470,  510, 550,  590,  640,  690,  740,  790,  840,  900,  960, 1020, 1090, 1160, 1250, 1400],
-            'alt1' :  [ 250,  280,  310,  340,  370,  400,  430,  470,  510, 550,  590,  640,  690,  740,  790,  840,  900,  960, 1020, 1090, 1160, 1250, 1400],
-            'alt2' :  [ 180,200,220,250,  280,  310,  340,  370,  400,  430,  470,  510, 550,  590,  640,  690,  740,  790,  840,  900, 1400],
-            'alt3' :  [ 180, 250,   340, 430, 550, 690,  900, 1160, 1400],
-        },
-        'cr_qcd_tight_v' : {
-             'nom' :  [180,210,250,300,350,400,500,600,750,1000],
-             'alt1' :  [250,300,350,400,500,600,750,1000],
-        },
-        'cr_qcd_loose_v' : {
-             'nom' :  [180,210,250,300,350,400,500,600,750,1000],
-             'alt1' :  [250,300,350,400,500,600,750,1000],
-        }
-    }
-
-    outdir = pjoin('./output/',indir.split('/')[-1])
-    
+    acc.load(distribution)
+
+    h = merge_extensions(acc[distribution], acc, reweight_pu=reweight_pu)
+    scale_xs_lumi(h)
+    h = merge_datasets(h)
+    h.axis('dataset').sorting = 'integral'
+    return h
+
+def parse_commandline():
+    parser = argparse.ArgumentParser(description='Data-driven QCD estimate.')
+    parser.add_argument('command', nargs='?', choices=['run', 'merge'], default='run', help='"merge" combines the outputs of all --shard runs and runs the remaining stages.')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG, help='YAML or TOML file describing the job matrix.')
+    parser.add_argument('--region', nargs='+', help='Only run these regions (shell-style patterns).')
+    parser.add_argument('--year', nargs='+', help='Only run these years.')
+    parser.add_argument('--tag', nargs='+', help='Only run these tags, e.g. "nominal_bin_*" (shell-style patterns).')
+    parser.add_argument('--stage', nargs='+', choices=STAGES, help='Only run these stages, overrides the config.')
+    parser.add_argument('--cachedir', type=str, default='./cache', help='Directory for the merged histogram cache.')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Ignore the cache and reload the input.')
+    parser.add_argument('--stream', action='store_true', help='Read the input chunk by chunk (indir/chunks/*, see ingestlib) instead of merging it in memory.')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of parallel worker processes.')
+    parser.add_argument('--force', action='store_true', help='Rerun all stages, even if their inputs did not change.')
+    parser.add_argument('--no-plots', action='store_true', help='Do not render any plots.')
+    parser.add_argument('--export-root', action='store_true', help='Also write the templates to ROOT files.')
+    parser.add_argument('--fit-unc', choices=['eigen', 'toys'], default='eigen', help='Source of the qcdfit uncertainty.')
+    parser.add_argument('--toys', type=int, default=10000, help='Number of toys per nominal fit for --fit-unc toys.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the toys.')
+    parser.add_argument('--trace', type=str, default=None, help='Write a JSON lines trace of stage timings, fit evaluations and written bytes.')
+    parser.add_argument('--shard', type=shard_arg, help='Only run shard i of N of the template and fit jobs, e.g. "0/4".')
+    return parser.parse_args()
+
+def shard_arg(value):
+    index, _, nshards = value.partition('/')
+    try:
+        index, nshards = int(index), int(nshards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, got {value}")
+    if not 0 <= index < nshards:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, {nshards}), got {index}")
+    return index, nshards
+
+STAGES = ['templates', 'fit', 'store', 'variations', 'closure', 'prediction', 'export', 'scan', 'optimize']
+
+# Stages split across shards, everything else runs in the merge
+SHARDED_STAGES = ['templates', 'fit', 'scan']
+
+def job_tags(config, bintag):
+    '''
+    Tags and dphi selections of the nominal estimate and the closure tests for one binning.
+    '''
+    cut = config['dphi_cut']
+    tags = [(f"nominal_bin_{bintag}", slice(0.0,cut), slice(cut,None))]
+    for closure_cut in sorted(config['closure_cuts']):
+        tags.append((f"closure_{closure_cut}_bin_{bintag}".replace('.','p'), slice(0.,closure_cut), slice(closure_cut,cut)))
+    return tags
+
+def build_jobs(config, args, source):
+    '''
+    Job graph for the full matrix in the config.
+
+    source maps (region, year) to the fingerprint of the input templates.
+    '''
+    outdir = config['outdir']
+    years = config['years']
+    fit_args = dict(fun=get_model(config['fit']['model']).fun, p0=tuple(config['fit']['p0']))
+    toy_args = dict(ntoys=args.toys, toy_seed=args.seed) if args.fit_unc == 'toys' else {}
+    # Only changes the starting point of each fit, it does not depend on any other job
+    warm_start = bool(config['fit'].get('warm_start', True))
+
     # Estimate for each region is completely independent
-    for region in ['cr_qcd_loose_v']:
+    jobs = []
+    for region in config['regions']:
+        parts = []
+        first_bintag = list(config['bins'][region])[0]
         # Independent estimates also for for different bins
-        for bintag, binvals in bins[region].items():
-            tag =  f"nominal_bin_{bintag}"
-            make_templates(
-                            acc,
-                            outdir,
-                            tag, 
-                            region=region, 
-                            bins=binvals)
-            fit_tf(
-                    outdir,
-                    tag, 
-                    region)
-            
-            # For validation/closure testing, use variable delta phi cuts
-            for cut in [0.2,0.3, 0.4]:
-                tag = f"closure_{cut}_bin_{bintag}".replace('.','p')
-
-                make_templates(
-                                acc, 
-                                outdir, 
-                                tag, 
-                                dphi_cr=slice(0.,cut), 
-                                dphi_sr=slice(cut,0.5),
-                                bins=binvals,
-                                region=region
-                                )
-                fit_tf(
-                        outdir, 
-                        tag, 
-                        region)
-
-        tf_variations(outdir, region)
-        # tf_closure(outdir, region)
-        tf_prediction(outdir, region)
+        for bintag, binvals in config['bins'][region].items():
+            for tag, dphi_cr, dphi_sr in job_tags(config, bintag):
+                # Toys are only needed for the fit entering the prediction
+                tag_fit_args = dict(fit_args, warm_start=warm_start, **(toy_args if tag == "nominal_bin_nom" else {}))
+                if warm_start and tag.startswith("nominal"):
+                    # The nominal fits also run from p0, as a baseline for the savings
+                    tag_fit_args['baseline'] = True
+                for year in years:
+                    labels = dict(region=region, year=year, tag=tag)
+                    template_args = dict(
+                                        bins=binvals,
+                                        region=region,
+                                        year=year,
+                                        dphi_cr=dphi_cr,
+                                        dphi_sr=dphi_sr
+                                        )
+                    jobs.append(Job(
+                                    f"templates_{region}_{tag}_{year}",
+                                    make_templates,
+                                    args=(Shared('templates'), outdir, tag),
+                                    kwargs=template_args,
+                                    fingerprint=dict(source=source.get((region, year)), **template_args),
+                                    outputs=[pjoin(outdir, f"templates_{region}_{tag}_{year}.npy")],
+                                    labels=dict(stage='templates', **labels)
+                                    ))
+                    jobs.append(Job(
+                                    f"fit_{region}_{tag}_{year}",
+                                    fit_tf,
+                                    args=(outdir, tag, region, year),
+                                    kwargs=tag_fit_args,
+                                    deps=[f"templates_{region}_{tag}_{year}"],
+                                    fingerprint=tag_fit_args,
+                                    outputs=[pjoin(outdir, f"tf_fit_{region}_{tag}_{year}.npy")],
+                                    labels=dict(stage='fit', **labels)
+                                    ))
+                    parts.append(f"{region}_{tag}_{year}")
+
+        # Continuous closure test, directly from the dense templates
+        for year in years:
+            scan_args = dict(binnings=config['bins'][region], dphi_cut=config['dphi_cut'], **fit_args)
+            jobs.append(Job(
+                            f"scan_{region}_{year}",
+                            dphi_scan,
+                            args=(Shared('templates'), outdir, region, year),
+                            kwargs=scan_args,
+                            fingerprint=dict(source=source.get((region, year)), **scan_args),
+                            outputs=[pjoin(outdir, f"dphi_scan_{region}_{year}.npy")],
+                            labels=dict(stage='scan', region=region, year=year, tag='dphi_scan')
+                            ))
+
+        # Recoil binning search, the candidates are split over several jobs
+        optimize = config['optimize']
+        grid = [(min_neff, max_rel_unc) for min_neff in optimize['min_neff'] for max_rel_unc in optimize['max_rel_unc']]
+        first_bins = config['bins'][region][first_bintag]
+        for year in years:
+            chunks = []
+            for ichunk in range(optimize['chunks']):
+                optimize_args = dict(
+                                    grid=grid[ichunk::optimize['chunks']],
+                                    recoil_range=optimize.get('range', [first_bins[0], first_bins[-1]]),
+                                    dphi_cut=config['dphi_cut'],
+                                    closure_cuts=config['closure_cuts'],
+                                    **fit_args
+                                    )
+                chunks.append(pjoin(outdir, f"binning_candidates_{region}_{year}_{ichunk}.npy"))
+                jobs.append(Job(
+                                f"optimize_{region}_{year}_{ichunk}",
+                                optimize_binning,
+                                args=(Shared('templates'), outdir, region, year, ichunk),
+                                kwargs=optimize_args,
+                                fingerprint=dict(source=source.get((region, year)), **optimize_args),
+                                outputs=[chunks[-1]],
+                                labels=dict(stage='optimize', region=region, year=year, tag=f'binopt_{ichunk}')
+                                ))
+            jobs.append(Job(
+                            f"optimize_front_{region}_{year}",
+                            binning_front,
+                            args=(outdir, region, year, chunks),
+                            deps=[f"optimize_{region}_{year}_{ichunk}" for ichunk in range(optimize['chunks'])],
+                            fingerprint={},
+                            outputs=[pjoin(outdir, f"binning_optimization_{region}_{year}.npy")],
+                            labels=dict(stage='optimize', region=region, year=year)
+                            ))
+
+        # Collect all templates and fits of the region in a single store each
+        template_store = pjoin(outdir, f"templates_{region}.npy")
+        jobs.append(Job(
+                        f"store_templates_{region}",
+                        merge_template_stores,
+                        args=([pjoin(outdir, f"templates_{part}.npy") for part in parts], template_store),
+                        deps=[f"templates_{part}" for part in parts],
+                        fingerprint={},
+                        outputs=[template_store],
+                        labels=dict(stage='store', region=region)
+                        ))
+        jobs.append(Job(
+                        f"export_templates_{region}",
+                        export_templates_root,
+                        args=(template_store, outdir, region),
+                        deps=[f"store_templates_{region}"],
+                        fingerprint={},
+                        outputs=[pjoin(outdir, f"templates_{region}_nominal_bin_nom.root")],
+                        labels=dict(stage='export', region=region)
+                        ))
+
+        fit_store = pjoin(outdir, f"tf_fits_{region}.npy")
+        jobs.append(Job(
+                        f"store_fits_{region}",
+                        merge_fit_stores,
+                        args=([pjoin(outdir, f"tf_fit_{part}.npy") for part in parts], fit_store),
+                        deps=[f"fit_{part}" for part in parts],
+                        fingerprint={},
+                        outputs=[fit_store],
+                        labels=dict(stage='store', region=region)
+                        ))
+        jobs.append(Job(
+                        f"variations_{region}",
+                        tf_variations,
+                        args=(outdir, region),
+                        kwargs=dict(years=years),
+                        deps=[f"store_fits_{region}"],
+                        fingerprint={},
+                        outputs=[pjoin(outdir,f"tf_variations_{region}_{year}.pdf") for year in years],
+                        labels=dict(stage='variations', region=region)
+                        ))
+        jobs.append(Job(
+                        f"closure_{region}",
+                        tf_closure,
+                        args=(outdir, region),
+                        kwargs=dict(years=years, cuts=config['closure_cuts']),
+                        deps=[f"store_fits_{region}", f"store_templates_{region}"],
+                        labels=dict(stage='closure', region=region)
+                        ))
+        jobs.append(Job(
+                        f"prediction_{region}",
+                        tf_prediction,
+                        args=(outdir, region),
+                        kwargs=dict(years=years, fit_unc=args.fit_unc),
+                        deps=[f"store_fits_{region}", f"store_templates_{region}"],
+                        fingerprint=dict(years=years, fit_unc=args.fit_unc),
+                        outputs=[pjoin(outdir, f"prediction_{region}.npy")],
+                        labels=dict(stage='prediction', region=region)
+                        ))
+
+    # One combine-ready file for all regions
+    jobs.append(Job(
+                    "write_prediction",
+                    write_prediction,
+                    args=(outdir, config['regions']),
+                    deps=[f"prediction_{region}" for region in config['regions']],
+                    fingerprint={},
+                    outputs=[pjoin(outdir, "qcdestimate.root")],
+                    labels=dict(stage='prediction')
+                    ))
+    return jobs
+
+def main():
+    args = parse_commandline()
+    config = load_config(args.config)
+    outdir = config['outdir']
+
+    stages = list(args.stage or config['stages'])
+    if args.export_root:
+        stages.append('export')
+    if args.no_plots:
+        # These stages only produce plots
+        stages = [x for x in stages if x not in ['variations', 'closure']]
+    # Sharded stages of this run, merging only needs their outputs
+    sharded = [x for x in stages if x in SHARDED_STAGES]
+    if args.command == 'merge':
+        stages = [x for x in stages if x not in SHARDED_STAGES]
+    elif args.shard:
+        stages = [x for x in stages if x in SHARDED_STAGES]
+
+    regions = [x for x in config['regions'] if not args.region or any(fnmatch.fnmatchcase(x, p) for p in args.region)]
+    years = [x for x in config['years'] if not args.year or str(x) in args.year]
+
+    # Off unless requested, workers inherit the setting
+    configure_trace(args.trace)
+
+    source = {}
+    if any(x in stages for x in ['templates', 'scan', 'optimize']):
+        # Merging, scale, etc
+        # are only redone if the input or the settings change
+        distribution = config['distribution']
+        reweight_pu = not ('nopu' in distribution)
+        groups = config['groups']
+        if args.stream:
+            # Chunk by chunk, the full accumulator is never in memory.
+            # Always built for the full config, so that selections share the cache.
+            with span("load_input", stage='input'):
+                templates = cached_distribution(
+                                    config['indir'],
+                                    distribution,
+                                    reweight_pu=reweight_pu,
+                                    builder=partial(stream_tensor, regions=config['regions'], years=config['years'], groups=groups),
+                                    cachedir=args.cachedir,
+                                    rebuild=args.rebuild_cache,
+                                    extra=('stream', config['regions'], config['years'], groups)
+                                    )
+        else:
+            with span("load_input", stage='input'):
+                h = cached_distribution(
+                                    config['indir'],
+                                    distribution,
+                                    reweight_pu=reweight_pu,
+                                    builder=load_distribution,
+                                    cachedir=args.cachedir,
+                                    rebuild=args.rebuild_cache
+                                    )
+
+            # Dataset to (group, year) mapping, cached next to the histogram.
+            # It is rebuilt if it was stored for other datasets.
+            cached_index = partial(cached_distribution,
+                                    config['indir'],
+                                    distribution,
+                                    reweight_pu=reweight_pu,
+                                    builder=lambda *_: hist_index(h, groups, years),
+                                    cachedir=args.cachedir,
+                                    extra=('groups', groups, years)
+                                    )
+            index = cached_index(rebuild=args.rebuild_cache)
+            if list(index[0]) != [str(x) for x in h.identifiers('dataset')]:
+                print("Cached dataset index does not match the histogram, rebuilding")
+                index = cached_index(rebuild=True)
+
+            # Dense arrays for all regions, groups and years are extracted once,
+            # every template below is a cheap slice of them
+            with span("from_hist", stage='input'):
+                templates = QCDTensor.from_hist(h, regions=regions, years=years, groups=groups, index=index)
+
+        # Workers inherit the templates through fork instead of pickling them
+        share('templates', templates)
+
+        # Stages are only rerun if their inputs changed
+        source = {(region, year) : templates.fingerprint(region, year) for region in regions for year in years}
+
+    os.makedirs(outdir, exist_ok=True)
+
+    # Shards may share the output directory,
+    # so each keeps its own bookkeeping
+    suffix = f"_shard{args.shard[0]}of{args.shard[1]}" if args.shard else ""
+
+    # Stages only queue plot specs, they are rendered at the end
+    queue_dir = pjoin(outdir, f"plotqueue{suffix}")
+    configure(None if args.no_plots else queue_dir)
+
+    jobs = select_jobs(
+                    build_jobs(config, args, source),
+                    region=regions,
+                    year=years,
+                    tag=args.tag
+                    )
+    if args.command == 'merge':
+        missing = [path for job in jobs if job.labels['stage'] in sharded for path in job.outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"Cannot merge, {len(missing)} shard outputs are missing, e.g. {missing[:5]}")
+
+    jobs = select_jobs(jobs, stage=stages)
+    if args.shard:
+        jobs = shard_jobs(jobs, *args.shard)
+    # Have the kernel read the stores the consumer stages open while the earlier
+    # stages run, stores rewritten by this run are in the page cache anyway
+    for region in sorted({job.labels['region'] for job in jobs if job.labels.get('stage') in ('variations', 'closure', 'prediction')}):
+        for kind, path in store_inputs(outdir, region):
+            warm_store(kind, path)
+    if any(job.labels.get('stage') == 'fit' for job in jobs):
+        # Imported lazily to keep the startup fast, but once here,
+        # so that forked workers inherit it instead of importing it on their first fit
+        import scipy.optimize
+    run_jobs(jobs, njobs=args.jobs, manifest=pjoin(outdir, f"manifest{suffix}.json"), force=args.force)
+    warm_start_report([job.outputs[0] for job in jobs if job.labels.get('stage') == 'fit'])
+
+    if not args.no_plots:
+        with span("render_queue", stage='plots'):
+            render_queue(queue_dir, njobs=args.jobs)
+
+    if args.trace:
+        to_chrome(args.trace, f"{os.path.splitext(args.trace)[0]}_chrome.json")
+        for (name, stage), entry in sorted(summarize(args.trace, by=('stage',)).items(), key=str):
+            print(f"{name:>20} {str(stage):>12}: {entry['calls']:6d} calls, total {entry['total']:.4g} {entry.get('unit', '')}")
+
 if __name__ == "__main__":
     main()
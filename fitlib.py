@@ -1,32 +1,258 @@
 import numpy as np
 from numpy import linalg as LA
 from inspect import signature
-from scipy.optimize import curve_fit
+from types import MappingProxyType
+
+import tracelib
+
+# Models are evaluated in place to avoid temporary arrays.
+# The clipping at zero is never active for non-negative parameters.
+def exponential(x,a,b,c):
+    ret = np.multiply(x, -b)
+    np.exp(ret, out=ret)
+    ret *= a
+    ret += c
+    np.maximum(ret, 0, out=ret)
+    return ret
+
+def exponential2(x,a,b,c,d):
+    ret = np.multiply(x, c)
+    ret += b
+    ret *= x
+    np.negative(ret, out=ret)
+    np.exp(ret, out=ret)
+    ret *= a
+    ret += d
+    np.maximum(ret, 0, out=ret)
+    return ret
+
+# Analytic derivatives with respect to the parameters, stacked along the last axis.
+# The clipping at zero is ignored for the same reason.
+def exponential_jac(x,a,b,c):
+    e = np.exp(np.multiply(x, -b))
+    ret = np.empty(e.shape + (3,))
+    ret[..., 0] = e
+    np.multiply(e, x, out=ret[..., 1])
+    ret[..., 1] *= -a
+    ret[..., 2] = 1
+    return ret
+
+def exponential2_jac(x,a,b,c,d):
+    e = np.multiply(x, c)
+    e += b
+    e *= x
+    np.negative(e, out=e)
+    np.exp(e, out=e)
+    ret = np.empty(e.shape + (4,))
+    ret[..., 0] = e
+    np.multiply(e, x, out=ret[..., 1])
+    ret[..., 1] *= -a
+    np.multiply(ret[..., 1], x, out=ret[..., 2])
+    ret[..., 3] = 1
+    return ret
+
+def log_polynomial(x, y, dy, deg):
+    '''
+    Coefficients of a weighted polynomial fit to log(y), highest power first.
+
+    None if there are too few positive points.
+    '''
+    x, y, dy = (np.asarray(v, dtype=float) for v in (x, y, dy))
+    ok = (y > 0) & (dy > 0) & np.isfinite(y) & np.isfinite(dy)
+    if ok.sum() <= deg:
+        return None
+    # The uncertainty of log(y) is dy/y
+    coef = np.polyfit(x[ok], np.log(y[ok]), deg, w=y[ok]/dy[ok])
+    return coef if np.all(np.isfinite(coef)) else None
+
+# Starting points from the fitted points themselves, the constant term starts at zero.
+def exponential_guess(x, y, dy):
+    coef = log_polynomial(x, y, dy, 1)
+    if coef is None:
+        return None
+    return [np.exp(coef[1]), max(-coef[0], 0), 0]
+
+def exponential2_guess(x, y, dy):
+    coef = log_polynomial(x, y, dy, 2)
+    if coef is None:
+        return None
+    return [np.exp(coef[2]), max(-coef[1], 0), max(-coef[0], 0), 0]
+
+class TFModel():
+    '''
+    A transfer factor model: function, analytic Jacobian,
+    parameter bounds and default starting point.
+
+    guess(x, y, dy) optionally derives a starting point from the points
+    to be fitted, it returns None if it cannot.
+    '''
+    def __init__(self, name, fun, jac, p0, bounds=(0,np.inf), guess=None):
+        self.name = name
+        self.fun = fun
+        self.jac = jac
+        self.p0 = list(p0)
+        self.npar = len(self.p0)
+        self.bounds = bounds
+        self.guess = guess
+
+MODELS = {}
+
+def register_model(model):
+    MODELS[model.name] = model
+    return model
+
+def get_model(fun):
+    '''
+    Looks up a model by name or by function.
+
+    Returns None for functions that are not registered,
+    unknown names raise a ValueError.
+    '''
+    if isinstance(fun, TFModel):
+        return fun
+    if isinstance(fun, str):
+        if fun not in MODELS:
+            raise ValueError(f"Unknown TF model {fun}, known models are {sorted(MODELS)}")
+        return MODELS[fun]
+    for model in MODELS.values():
+        if model.fun is fun:
+            return model
+    return None
+
+register_model(TFModel('exponential', exponential, exponential_jac, p0=[0.5,1e-2,0], guess=exponential_guess))
+register_model(TFModel('exponential2', exponential2, exponential2_jac, p0=[0.5,1e-2,0,0], guess=exponential2_guess))
+
+def variation_names(npar):
+    '''
+    Variation names in the order TFFit.fit creates them.
+    '''
+    names = ['best']
+    for i in range(npar):
+        names += [f'fit_{i}_dn', f'fit_{i}_up']
+    return names
+
+def eigen_variations(popt, pcov):
+    '''
+    Parameter variations along the eigenvectors of the covariance matrix.
+
+    Works on single fits as well as on stacks of fits (leading axes).
+    Returns a dict with the keys used by TFFit.pars.
+    '''
+    pcov_w, pcov_v  = LA.eigh(pcov)
+    pars = {}
+    for i in range(pcov_w.shape[-1]):
+        w = pcov_w[..., i, None]
+        variation = np.sign(w)*np.sqrt(np.abs(w))*pcov_v[..., :, i]
+        pars[f'fit_{i}_dn'] = popt - variation
+        pars[f'fit_{i}_up'] = popt + variation
+    return pars
 
 class TFFit():
-    def __init__(self, x, y, dy, fun, p0):
+    def __init__(self, x, y, dy, fun, p0=None):
         self.x = x
         self.y = y
         self.dy = dy
         self.fun = fun
         self.npar = len(signature(fun).parameters)
-        self.p0 = p0
+        model = get_model(fun)
+        if model is None and p0 is None:
+            raise ValueError(f"Unknown TF model {getattr(fun, '__name__', fun)}, register it or pass p0")
+        self.p0 = p0 if p0 is not None else model.p0
         self.pars = {}
 
+    @property
+    def pars(self):
+        '''
+        Parameters per variation, read-only views of the (nvar, npar) array self.parameters.
+
+        Evaluations are memoized, so the parameters can only be changed
+        by assigning a new dict to pars, which resets the memo.
+        '''
+        return MappingProxyType(dict(zip(self.variations, self.parameters)))
+
+    @pars.setter
+    def pars(self, pars):
+        self.variations = list(pars.keys())
+        self.parameters = np.array([pars[key] for key in self.variations], dtype=float)
+        self.parameters.flags.writeable = False
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        # Fits pickled before the parameter array was introduced
+        pars = state.pop('pars', None)
+        self.__dict__.update(state)
+        if pars is not None:
+            self.pars = pars
+        self._cache = {}
+
+    @property
+    def npoint(self):
+        return len(self.x) if self.x is not None else 0
+
+    def result(self, keep_inputs=False):
+        '''
+        Compact FitResult with the fitted parameters, optionally referencing the input points.
+        '''
+        model = get_model(self.fun)
+        if model is None:
+            raise ValueError(f"Only registered models have a compact result, got {self.fun}")
+        pars = self.pars
+        return FitResult(
+            model.name,
+            [pars[key] for key in variation_names(model.npar)],
+            covariance=getattr(self, 'pcov', None),
+            chi2=getattr(self, 'chi2', np.nan),
+            npoint=self.npoint,
+            toy_parameters=getattr(self, 'toy_parameters', None),
+            inputs=(self.x, self.y, self.dy) if keep_inputs else None,
+            )
+
     def fit(self):
-        popt, pcov = curve_fit(
-                        self.fun,
-                        self.x,
-                        self.y,
-                        sigma=self.dy,
-                        p0=self.p0,
-                        absolute_sigma=True,
-                        maxfev=20000,
-                        bounds=(0,np.inf)
-                        )
+        from scipy.optimize import curve_fit
+
+        model = get_model(self.fun)
+        if model is not None:
+            options = dict(jac=model.jac, bounds=model.bounds)
+        else:
+            # Finite differences may need many evaluations
+            options = dict(maxfev=20000, bounds=(0,np.inf))
+
+        # Count evaluations through wrappers, curve_fit does not report them for all methods
+        calls = {'fun' : 0, 'jac' : 0}
+        def counted(name, f):
+            def wrapper(*args):
+                calls[name] += 1
+                return f(*args)
+            return wrapper
+        if 'jac' in options:
+            options['jac'] = counted('jac', options['jac'])
+
+        with tracelib.span("TFFit.fit", model=model.name if model else self.fun.__name__):
+            popt, pcov = curve_fit(
+                            counted('fun', self.fun),
+                            self.x,
+                            self.y,
+                            sigma=self.dy,
+                            p0=self.p0,
+                            absolute_sigma=True,
+                            **options
+                            )
+        self.nfev = calls['fun']
+        # One Jacobian per iteration of the trust region solver
+        self.njev = calls['jac']
+        tracelib.count("fit.nfev", self.nfev)
+        tracelib.count("fit.njev", self.njev)
+
+        self.pcov = pcov
+        self.chi2 = np.sum(((self.fun(self.x, *popt) - self.y) / self.dy)**2)
 
         # Nominal best fit
-        self.pars['best'] = popt
+        pars = {'best' : popt}
         
         # Diagonalize the covariance matrix
         pcov_w, pcov_v  = LA.eig(pcov)
@@ -34,20 +260,333 @@ class TFFit():
         # Add the variations
         for i in range(len(pcov_w)):
             variation = np.sign(pcov_w[i])*np.sqrt(np.abs(pcov_w[i]))*pcov_v[:,i]
-            self.pars[f'fit_{i}_dn'] = popt - variation
-            self.pars[f'fit_{i}_up'] = popt + variation
+            pars[f'fit_{i}_dn'] = popt - variation
+            pars[f'fit_{i}_up'] = popt + variation
+        self.pars = pars
+
+    def fit_toys(self, ntoys=10000, seed=None, method='gauss'):
+        '''
+        Refits fluctuated copies of the TF histogram in one batch.
+
+        With method="gauss", every point is smeared by its uncertainty, with
+        method="poisson", by a Poisson variation of its effective number of entries.
+        The best-fit parameters of all converged toys end up in self.toy_parameters.
+        '''
+        rng = np.random.default_rng(seed)
+        y = np.asarray(self.y, dtype=float)
+        dy = np.asarray(self.dy, dtype=float)
+        if method == 'gauss':
+            toys = y + dy * rng.standard_normal((ntoys, len(y)))
+        elif method == 'poisson':
+            neff = np.zeros(len(y))
+            neff[dy>0] = (y[dy>0] / dy[dy>0])**2
+            toys = y * rng.poisson(neff, size=(ntoys, len(y))) / np.where(neff>0, neff, 1)
+        else:
+            raise ValueError(f"Unknown toy method: {method}")
+
+        batch = BatchTFFit(self.x, toys, dy, self.fun, p0=self.pars['best'])
+        batch.fit()
+        self.toy_parameters = batch.pars['best'][batch.converged]
+
+    def toy_envelope(self, x, quantiles=(15.87, 84.13)):
+        '''
+        Percentile band of the toy fits, alternative to the eigenvector envelope.
+        '''
+        x = np.asarray(x, dtype=float)
+        shape = (len(self.toy_parameters),) + (1,) * x.ndim
+        vals = self.fun(x, *[self.toy_parameters[:, i].reshape(shape) for i in range(self.toy_parameters.shape[1])])
+        return tuple(np.percentile(vals, quantiles, axis=0))
+
+    def _evaluated(self, x):
+        '''
+        Memoized evaluation of all variations on a grid, read-only.
+        '''
+        x = np.asarray(x, dtype=float)
+        key = (x.shape, x.tobytes())
+        if key not in self._cache:
+            if len(self._cache) >= 16:
+                self._cache.pop(next(iter(self._cache)))
+            shape = (len(self.variations),) + (1,) * x.ndim
+            vals = self.fun(x, *[self.parameters[:, i].reshape(shape) for i in range(self.parameters.shape[1])])
+            vals.flags.writeable = False
+            self._cache[key] = vals
+        return self._cache[key]
+
+    def evaluate_array(self, x):
+        '''
+        Evaluates all variations at once, returns an array of shape (nvar,) + x.shape.
+
+        Like evaluate and evaluate_all, it returns a copy that callers may modify.
+        '''
+        return self._evaluated(x).copy()
 
     def envelope(self, x):
-        vals = np.stack(self.evaluate_all(x).values())
+        vals = self._evaluated(x)
         return np.min(vals, axis=0), np.max(vals, axis=0)
 
+    def evaluate(self, x, variation='best'):
+        return self._evaluated(x)[self.variations.index(variation)].copy()
+
+    def evaluate_all(self, x):
+        return dict(zip(self.variations, self.evaluate_array(x)))
+
+class FitResult():
+    '''
+    Slim, read-only TF fit result with the evaluation API of TFFit.
+
+    The variations (in the order of variation_names) and the covariance share
+    one contiguous array, the model is referenced by its registered name.
+    inputs optionally points to the (x, y, dy) arrays the fit was made on,
+    e.g. rows of a BatchTFFit, and is not copied. As for TFFit, pars holds
+    read-only views and the evaluations return copies.
+    '''
+    __slots__ = ('model', 'npar', 'chi2', 'npoint', 'inputs', '_data', '_toys', '_cache')
+
+    def __init__(self, model, parameters, covariance=None, chi2=np.nan, npoint=0, toy_parameters=None, inputs=None):
+        parameters = np.asarray(parameters, dtype=float)
+        npar = parameters.shape[1]
+        if covariance is None:
+            covariance = np.full((npar, npar), np.nan)
+        data = np.concatenate([parameters.ravel(), np.ravel(covariance)])
+        toys = None if toy_parameters is None or not len(toy_parameters) else np.asarray(toy_parameters, dtype=float)
+        self._set(model, npar, chi2, npoint, data, toys, inputs)
+
+    def _set(self, model, npar, chi2, npoint, data, toys, inputs):
+        self.model = model
+        self.npar = npar
+        self.chi2 = float(chi2)
+        self.npoint = int(npoint)
+        # Read-only views, the arrays passed in stay writable
+        self._data = data.view()
+        self._data.flags.writeable = False
+        self._toys = None if toys is None else toys.view()
+        if self._toys is not None:
+            self._toys.flags.writeable = False
+        self.inputs = inputs
+        self._cache = None
+
+    @classmethod
+    def _restore(cls, model, npar, chi2, npoint, data, toys, inputs):
+        self = cls.__new__(cls)
+        self._set(model, npar, chi2, npoint, np.frombuffer(data), toys, inputs)
+        return self
+
+    def __reduce__(self):
+        # The packed array as raw bytes, the evaluation cache is rebuilt on demand
+        return (FitResult._restore, (self.model, self.npar, self.chi2, self.npoint, self._data.tobytes(), self._toys, self.inputs))
+
+    @property
+    def parameters(self):
+        n = self.npar
+        return self._data[:(2*n+1)*n].reshape(2*n+1, n)
+
+    @property
+    def covariance(self):
+        n = self.npar
+        return self._data[(2*n+1)*n:].reshape(n, n)
+
+    @property
+    def toy_parameters(self):
+        return self._toys if self._toys is not None else np.zeros((0, self.npar))
+
+    @property
+    def fun(self):
+        return MODELS[self.model].fun
+
+    @property
+    def variations(self):
+        return variation_names(self.npar)
+
+    @property
+    def pars(self):
+        return MappingProxyType(dict(zip(self.variations, self.parameters)))
+
+    @property
+    def pcov(self):
+        return self.covariance
+
+    def _evaluated(self, x):
+        '''
+        All variations at x, memoized per grid. The result must not be modified.
+        '''
+        x = np.asarray(x, dtype=float)
+        key = (x.shape, x.tobytes())
+        if self._cache is None:
+            self._cache = {}
+        if key not in self._cache:
+            if len(self._cache) >= 16:
+                self._cache.pop(next(iter(self._cache)))
+            parameters = self.parameters
+            shape = (len(parameters),) + (1,) * x.ndim
+            vals = self.fun(x, *[parameters[:, i].reshape(shape) for i in range(self.npar)])
+            vals.flags.writeable = False
+            self._cache[key] = vals
+        return self._cache[key]
+
+    def evaluate_array(self, x):
+        '''
+        Evaluates all variations at once, returns an array of shape (nvar,) + x.shape.
+
+        Like evaluate and evaluate_all, it returns a copy that callers may modify.
+        '''
+        return self._evaluated(x).copy()
+
+    def envelope(self, x):
+        vals = self._evaluated(x)
+        return np.min(vals, axis=0), np.max(vals, axis=0)
 
-            
     def evaluate(self, x, variation='best'):
-        return self.fun(x, *self.pars[variation])
+        return self._evaluated(x)[self.variations.index(variation)].copy()
 
     def evaluate_all(self, x):
-        ret = {}
-        for variation in self.pars.keys():
-            ret[variation] = self.evaluate(x, variation)
+        return dict(zip(self.variations, self.evaluate_array(x)))
+
+    def toy_envelope(self, x, quantiles=(15.87, 84.13)):
+        '''
+        Percentile band of the toy fits, alternative to the eigenvector envelope.
+        '''
+        if self._toys is None:
+            raise ValueError("The fit has no toys, rerun it with toys")
+        x = np.asarray(x, dtype=float)
+        shape = (len(self._toys),) + (1,) * x.ndim
+        vals = self.fun(x, *[self._toys[:, i].reshape(shape) for i in range(self.npar)])
+        return tuple(np.percentile(vals, quantiles, axis=0))
+
+class BatchTFFit():
+    '''
+    Simultaneous fit of many independent TF problems.
+
+    x, y and dy have the shape (nfit, npoint). Fits with fewer points are padded
+    and the padding is excluded via mask. All chi2 minimizations run together in a
+    vectorized Levenberg-Marquardt solver with analytic Jacobians; parameters are
+    kept within the bounds by freezing those that sit at a bound and are pushed out.
+    '''
+    def __init__(self, x, y, dy, fun, p0=None, mask=None):
+        self.x = np.atleast_2d(np.asarray(x, dtype=float))
+        self.y = np.atleast_2d(np.asarray(y, dtype=float))
+        self.dy = np.atleast_2d(np.asarray(dy, dtype=float))
+        self.nfit = self.y.shape[0]
+        self.x = np.broadcast_to(self.x, self.y.shape)
+        self.dy = np.broadcast_to(self.dy, self.y.shape)
+        model = get_model(fun)
+        if model is None:
+            raise ValueError(f"Unknown TF model {getattr(fun, '__name__', fun)}, BatchTFFit needs a registered model")
+        self.fun = model.fun
+        self.jac = model.jac
+        self.npar = model.npar
+        if p0 is None:
+            p0 = model.p0
+        self.p0 = np.broadcast_to(np.asarray(p0, dtype=float), (self.nfit, self.npar)).copy()
+        if mask is None:
+            mask = np.ones(self.y.shape, dtype=bool)
+        self.mask = np.asarray(mask, dtype=bool) & (self.dy > 0)
+        self.lo = np.broadcast_to(np.asarray(model.bounds[0], dtype=float), (self.npar,))
+        self.hi = np.broadcast_to(np.asarray(model.bounds[1], dtype=float), (self.npar,))
+        self.pars = {}
+
+    def _weights(self):
+        w = np.zeros(self.y.shape)
+        w[self.mask] = 1 / self.dy[self.mask]
+        return w
+
+    def _chi2(self, p, x, y, w):
+        r = (self.fun(x, *p.T[..., None]) - y) * w
+        return np.sum(r*r, axis=-1)
+
+    def fit(self, max_iter=200, ftol=1e-10, xtol=1e-10):
+        w = self._weights()
+        p = np.clip(self.p0, self.lo, self.hi)
+        chi2 = self._chi2(p, self.x, self.y, w)
+        lam = np.full(self.nfit, 1e-3)
+        active = np.ones(self.nfit, dtype=bool)
+        self.niter = np.zeros(self.nfit, dtype=int)
+        self.nfev = np.ones(self.nfit, dtype=int)
+        eye = np.eye(self.npar)
+
+        for _ in range(max_iter):
+            if not np.any(active):
+                break
+            pa = p[active]
+            wa = w[active]
+            xa = self.x[active]
+            ya = self.y[active]
+            r = (self.fun(xa, *pa.T[..., None]) - ya) * wa
+            J = self.jac(xa, *pa.T[..., None]) * wa[..., None]
+            A = np.einsum('fni,fnj->fij', J, J)
+            g = np.einsum('fni,fn->fi', J, r)
+
+            # Freeze parameters sitting at a bound with the gradient pointing outward
+            free = ~(((pa <= self.lo) & (g > 0)) | ((pa >= self.hi) & (g < 0)))
+            A = A * (free[:, :, None] & free[:, None, :]) + eye * (~free)[:, :, None]
+            g = g * free
+
+            # Parameters without any sensitivity, e.g. b for a = 0, get unit damping
+            diag = np.einsum('fii->fi', A)
+            diag = np.where(diag > 0, diag, 1.)
+            damped = A + lam[active, None, None] * eye * diag[:, :, None]
+            step = -LA.solve(damped, g[..., None])[..., 0]
+            trial = np.clip(pa + step, self.lo, self.hi)
+            chi2_trial = self._chi2(trial, xa, ya, wa)
+
+            self.niter[active] += 1
+            self.nfev[active] += 1
+            better = chi2_trial < chi2[active]
+
+            idx = np.flatnonzero(active)
+            dchi2 = chi2[idx] - chi2_trial
+            dpar = np.abs(trial - pa).max(axis=-1) / (np.abs(pa).max(axis=-1) + xtol)
+
+            p[idx[better]] = trial[better]
+            chi2[idx[better]] = chi2_trial[better]
+            lam[idx[better]] = lam[idx[better]] / 10
+            lam[idx[~better]] = lam[idx[~better]] * 10
+
+            done = (better & ((dchi2 <= ftol * chi2_trial) | (dpar <= xtol))) | (lam[idx] > 1e12)
+            active[idx[done]] = False
+
+        self.converged = ~active
+        self.chi2 = chi2
+        tracelib.count("batchfit.fits", self.nfit)
+        tracelib.count("batchfit.niter", int(self.niter.sum()))
+        tracelib.count("batchfit.nfev", int(self.nfev.sum()))
+
+        # Covariance from the Jacobian at the minimum, as in curve_fit with absolute_sigma
+        J = self.jac(self.x, *p.T[..., None]) * w[..., None]
+        pcov = LA.pinv(np.einsum('fni,fnj->fij', J, J))
+
+        self.pcov = pcov
+        self.pars['best'] = p
+        self.pars.update(eigen_variations(p, pcov))
+
+    def fits(self):
+        '''
+        Splits the batch into TFFit objects with the usual per-fit API.
+        '''
+        ret = []
+        for i in range(self.nfit):
+            m = self.mask[i]
+            fit = TFFit(self.x[i][m], self.y[i][m], self.dy[i][m], self.fun, self.p0[i])
+            fit.pars = {key : val[i] for key, val in self.pars.items()}
+            fit.pcov = self.pcov[i]
+            fit.chi2 = self.chi2[i]
+            ret.append(fit)
         return ret
+
+    def results(self, keep_inputs=False):
+        '''
+        Splits the batch into FitResult objects, optionally referencing rows of the batch inputs.
+        '''
+        model = get_model(self.fun)
+        parameters = np.stack([self.pars[key] for key in variation_names(self.npar)], axis=1)
+        npoint = self.mask.sum(axis=-1)
+        return [
+            FitResult(
+                model.name,
+                parameters[i],
+                covariance=self.pcov[i],
+                chi2=self.chi2[i],
+                npoint=npoint[i],
+                inputs=(self.x[i], self.y[i], self.dy[i]) if keep_inputs else None,
+                )
+            for i in range(self.nfit)
+            ]
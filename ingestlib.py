@@ -0,0 +1,129 @@
+import os
+import re
+from collections import defaultdict
+
+from templatelib import GROUPS, QCDTensor
+
+pjoin = os.path.join
+
+# Small per-chunk entries needed to normalize the datasets
+BOOKKEEPING = ['sumw', 'sumw_pileup', 'nevents']
+
+# Suffixes stripped from extension datasets, as in bucoffea's merge_extensions
+EXTENSIONS = [r'_ext\d+', r'_new_+pmx', r'_PSweights']
+
+# Input layouts
+# -------------
+# Merged: indir is a klepto dir_archive keyed by accumulator name
+#         ('sumw', 'sumw_pileup', 'nevents', the distributions), as read by
+#         load_distribution. It is streamed as a single chunk.
+# Chunked: indir/chunks/<chunk name>/ are dir_archives with the same keys,
+#         one per processing chunk, e.g. per coffea output file.
+#         write_chunk and write_chunks create them.
+CHUNKS = 'chunks'
+
+def _archive(path):
+    from klepto.archives import dir_archive
+
+    # Without an in-memory cache, only the entries that are read are deserialized
+    return dir_archive(path, serialized=True, cached=False)
+
+def write_chunk(indir, name, accumulator):
+    '''
+    Writes one chunk of the chunked layout, keyed by accumulator name.
+    '''
+    archive = _archive(pjoin(indir, CHUNKS, name))
+    for key, value in accumulator.items():
+        archive[key] = value
+
+def write_chunks(indir, paths):
+    '''
+    Converts per-chunk coffea outputs into the chunked layout, one file at a time.
+    '''
+    from coffea.util import load
+
+    for path in paths:
+        write_chunk(indir, os.path.splitext(os.path.basename(path))[0], load(path))
+
+def iter_chunks(indir):
+    '''
+    Yields (name, archive) for every chunk of a merged or chunked input directory.
+
+    Entries are only deserialized when they are accessed, so the
+    caller decides what is held in memory.
+    '''
+    chunkdir = pjoin(indir, CHUNKS)
+    if not os.path.isdir(chunkdir):
+        yield os.path.basename(indir.rstrip('/')), _archive(indir)
+        return
+    for name in sorted(os.listdir(chunkdir)):
+        if os.path.isdir(pjoin(chunkdir, name)):
+            yield name, _archive(pjoin(chunkdir, name))
+
+def bookkeeping(indir):
+    '''
+    Sums the bookkeeping entries over all chunks, reading nothing else.
+    '''
+    totals = {}
+    for _, chunk in iter_chunks(indir):
+        keys = chunk.keys()
+        for key in BOOKKEEPING:
+            if key not in keys:
+                continue
+            totals[key] = totals[key] + chunk[key] if key in totals else chunk[key]
+    return totals
+
+def base_dataset(name):
+    '''
+    Name of the dataset an extension belongs to.
+    '''
+    for regex in EXTENSIONS:
+        name = re.sub(regex, '', name)
+    return name
+
+def normalization(totals, reweight_pu):
+    '''
+    Sum of weights per base dataset, over all chunks and all extensions.
+    '''
+    sumw = defaultdict(float)
+    for dataset, w in totals['sumw_pileup' if reweight_pu else 'sumw'].items():
+        sumw[base_dataset(str(dataset))] += w
+    return sumw
+
+def stream_tensor(indir, distribution, reweight_pu, regions, years, groups=GROUPS):
+    '''
+    Builds the QCDTensor chunk by chunk, without ever merging the full accumulator.
+
+    A chunk usually holds a single dataset or extension, so merge_extensions
+    cannot normalize it: it would only see the sum of weights of that chunk.
+    Extensions are merged without scaling, and every base dataset is divided
+    by its sum of weights over all chunks and extensions instead. Cross section
+    and luminosity scaling and the dataset merging are linear and applied per
+    chunk. Only the dense arrays of the estimate and the distribution of one
+    chunk are held in memory.
+    '''
+    from bucoffea.plot.util import (merge_datasets, merge_extensions,
+                                    scale_xs_lumi)
+
+    # First pass only reads the sums of weights
+    totals = bookkeeping(indir)
+    sumw = normalization(totals, reweight_pu)
+
+    tensor = None
+    for name, chunk in iter_chunks(indir):
+        if distribution not in chunk.keys():
+            continue
+        h = merge_extensions(chunk[distribution], totals, reweight_pu=reweight_pu, noscale=True)
+        h.scale({d : 1/sumw[d] for d in map(str, h.identifiers('dataset'))}, axis='dataset')
+        scale_xs_lumi(h)
+        h = merge_datasets(h)
+        part = QCDTensor.from_hist(h, regions=regions, years=years, groups=groups)
+        if tensor is None:
+            tensor = part
+        else:
+            tensor.add(part)
+        del h, part
+
+    if tensor is None:
+        raise RuntimeError(f"No chunk in {indir} contains the distribution {distribution}")
+    return tensor
@@ -0,0 +1,98 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from storelib import FitStore, TemplateStore, toys_path
+
+LOADERS = {
+    'fits' : FitStore,
+    'templates' : TemplateStore,
+}
+
+def warm(path, blocksize=1<<20):
+    '''
+    Pulls a file into the page cache, so that memory-mapped reads of it,
+    in this or any other process, do not wait for the disk.
+
+    Where posix_fadvise exists the kernel reads in the background and this
+    returns right away, otherwise the file is read through.
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return
+        while f.read(blocksize):
+            pass
+
+def warm_store(kind, path):
+    '''
+    Warms all files of a store.
+    '''
+    warm(path)
+    if kind == 'fits':
+        warm(toys_path(path))
+
+def open_store(kind, path):
+    '''
+    Warms the files of a store and opens it memory-mapped.
+    '''
+    warm_store(kind, path)
+    return LOADERS[kind](path)
+
+class Prefetcher():
+    '''
+    Reads stores in a thread pool ahead of their use.
+
+    Stores stay memory-mapped, the threads pull their files into the page
+    cache, which also serves forked workers that open the same files.
+    Opened stores are kept in a bounded LRU keyed on path, size and
+    modification time, so consecutive stages in the same process share them
+    and rewritten files are opened again.
+    '''
+    def __init__(self, max_workers=4, max_items=16):
+        self.max_items = max_items
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, kind, path):
+        '''
+        Starts loading a store if it is not cached yet, returns its future.
+        '''
+        st = os.stat(path)
+        key = (kind, os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            future = self._pool.submit(open_store, kind, path)
+            self._items[key] = future
+            while len(self._items) > self.max_items:
+                _, oldest = self._items.popitem(last=False)
+                oldest.cancel()
+            return future
+
+    def get(self, kind, path):
+        return self.prefetch(kind, path).result()
+
+_prefetcher = None
+_pid = None
+
+def prefetcher():
+    '''
+    The prefetcher of this process, forked workers create their own.
+    '''
+    global _prefetcher, _pid
+    if _pid != os.getpid():
+        _prefetcher = Prefetcher()
+        _pid = os.getpid()
+    return _prefetcher
+
+def load(kind, path):
+    '''
+    Returns a loaded store, waiting only if it is not ready yet.
+    '''
+    return prefetcher().get(kind, path)
@@ -0,0 +1,262 @@
+import fnmatch
+import hashlib
+import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from tracelib import span
+
+# Objects shared read-only with the workers.
+# They are registered before the pool is created and inherited through fork.
+_shared = {}
+
+def share(name, obj):
+    _shared[name] = obj
+
+class Shared():
+    '''
+    Placeholder for a shared object in the arguments of a job.
+
+    It is resolved inside the worker, so the object itself is never pickled.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+def _resolve(value):
+    if isinstance(value, Shared):
+        return _shared[value.name]
+    return value
+
+def _execute(fun, args, kwargs, name=None, labels=None):
+    args = [_resolve(x) for x in args]
+    kwargs = {k : _resolve(v) for k, v in kwargs.items()}
+    labels = labels or {}
+    with span(labels.get('stage', name or fun.__name__), job=name, **labels):
+        return fun(*args, **kwargs)
+
+class Job():
+    '''
+    A single unit of work in the job graph.
+
+    A job only starts once all the jobs named in deps have finished.
+    If a fingerprint is given, the job is skipped when neither the fingerprint
+    nor any of its dependencies changed since the last run and all its
+    outputs still exist. Labels (e.g. stage, region, year, tag) are used
+    to select subsets of the job graph. Files in inputs, typically outputs
+    of jobs that are not part of this run, are tracked by size and mtime.
+    upstream holds the content keys of such dependencies that are not run.
+    '''
+    def __init__(self, name, fun, args=(), kwargs=None, deps=(), fingerprint=None, outputs=(), labels=None):
+        self.name = name
+        self.fun = fun
+        self.args = tuple(args)
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.deps = list(deps)
+        self.fingerprint = fingerprint
+        self.outputs = list(outputs)
+        self.labels = labels if labels is not None else {}
+        self.inputs = []
+        self.upstream = {}
+
+def select_jobs(jobs, **selectors):
+    '''
+    Keeps the jobs whose labels match all selectors.
+
+    Each selector is a list of shell-style patterns, None selects everything.
+    Jobs without the corresponding label always match. Dependencies on
+    deselected jobs are dropped: their outputs are taken from earlier runs
+    and become inputs of the job, their content keys stay part of its key.
+    '''
+    def matches(job):
+        for key, patterns in selectors.items():
+            if not patterns or key not in job.labels:
+                continue
+            if not any(fnmatch.fnmatchcase(str(job.labels[key]), str(p)) for p in patterns):
+                return False
+        return True
+
+    return _prune([job for job in jobs if matches(job)], jobs)
+
+def _upstream_key(name, byname, memo):
+    '''
+    Content key of a job that is not run, chained like in run_jobs.
+    '''
+    if name not in memo:
+        job = byname[name]
+        memo[name] = job_key(job, {d : _upstream_key(d, byname, memo) for d in job.deps})
+    return memo[name]
+
+def _prune(selected, jobs):
+    '''
+    Turns dependencies on jobs outside of selected into inputs,
+    keeping their content keys.
+    '''
+    names = set(job.name for job in selected)
+    byname = {job.name : job for job in jobs}
+    memo = {}
+    for job in selected:
+        dropped = [d for d in job.deps if d not in names]
+        job.inputs += [x for d in dropped for x in byname[d].outputs]
+        job.upstream.update({d : _upstream_key(d, byname, memo) for d in dropped})
+        job.deps = [d for d in job.deps if d in names]
+    return selected
+
+def shard_jobs(jobs, index, nshards, keys=('region', 'year', 'tag')):
+    '''
+    Keeps the jobs of shard index out of nshards.
+
+    Jobs are grouped by the labels in keys, so that e.g. the templates and the
+    fit of one (region, year, tag) end up in the same shard. The groups are
+    sorted and dealt out round-robin, which is deterministic for the same job
+    matrix on every node. Jobs without all of the labels do not belong to any
+    shard, they run when the shards are merged. Dependencies on jobs of other
+    shards are dropped like in select_jobs.
+    '''
+    groups = sorted(set(
+        tuple(str(job.labels[key]) for key in keys)
+        for job in jobs if all(key in job.labels for key in keys)
+        ))
+    mine = set(groups[index::nshards])
+    return _prune([
+        job for job in jobs
+        if all(key in job.labels for key in keys)
+        and tuple(str(job.labels[key]) for key in keys) in mine
+        ], jobs)
+
+def _json_default(obj):
+    if isinstance(obj, slice):
+        return [obj.start, obj.stop, obj.step]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if callable(obj):
+        return f"{obj.__module__}.{obj.__name__}"
+    raise TypeError(f"Cannot fingerprint object of type {type(obj)}")
+
+def job_key(job, keys):
+    '''
+    Content hash of a job: its own fingerprint chained with the keys of its dependencies,
+    including those that were deselected and are not run.
+
+    Jobs without a fingerprint get a unique key, so they and everything
+    downstream of them always run.
+    '''
+    if job.fingerprint is None:
+        return uuid.uuid4().hex
+    sha = hashlib.sha256()
+    sha.update(job.name.encode())
+    sha.update(json.dumps(job.fingerprint, sort_keys=True, default=_json_default).encode())
+    deps = dict(job.upstream, **{d : keys[d] for d in job.deps})
+    for dep in sorted(deps):
+        sha.update(deps[dep].encode())
+    for path in sorted(job.inputs):
+        stat = os.stat(path) if os.path.exists(path) else None
+        sha.update(repr((path, stat and stat.st_size, stat and stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+class Manifest():
+    '''
+    Records the key each job had when it last finished successfully.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.keys = json.load(f)
+
+    def is_current(self, job, key):
+        return self.keys.get(job.name) == key and all(os.path.exists(x) for x in job.outputs)
+
+    def update(self, name, key):
+        self.keys[name] = key
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self.keys, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def _ready(pending, done):
+    return [name for name, job in pending.items() if all(d in done for d in job.deps)]
+
+def _check(jobs):
+    names = set()
+    for job in jobs:
+        if job.name in names:
+            raise ValueError(f"Duplicate job name: {job.name}")
+        names.add(job.name)
+    for job in jobs:
+        missing = [d for d in job.deps if d not in names]
+        if missing:
+            raise ValueError(f"Job {job.name} depends on unknown jobs: {missing}")
+
+def run_jobs(jobs, njobs=1, manifest=None, force=False):
+    '''
+    Executes a list of jobs respecting their dependencies.
+
+    With njobs > 1, independent jobs run concurrently in a forked process pool.
+    If a manifest path is given, jobs whose inputs did not change are skipped,
+    unless force is set. Returns a dict mapping job names to return values,
+    skipped jobs map to None.
+    '''
+    _check(jobs)
+    manifest = Manifest(manifest)
+    pending = {job.name : job for job in jobs}
+    results = {}
+    keys = {}
+
+    def schedule(name):
+        '''
+        Returns True if the job has to run, records the skipped ones.
+        '''
+        job = pending[name]
+        keys[name] = job_key(job, keys)
+        if not force and manifest.is_current(job, keys[name]):
+            print(f"Skipping up-to-date job {name}")
+            del pending[name]
+            results[name] = None
+            return False
+        return True
+
+    if njobs <= 1:
+        while pending:
+            ready = _ready(pending, results)
+            if not ready:
+                raise RuntimeError(f"Circular dependencies between jobs: {sorted(pending)}")
+            for name in ready:
+                if not schedule(name):
+                    continue
+                job = pending.pop(name)
+                results[name] = _execute(job.fun, job.args, job.kwargs, job.name, job.labels)
+                manifest.update(name, keys[name])
+        return results
+
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=njobs, mp_context=ctx) as pool:
+        running = {}
+        while pending or running:
+            ready = _ready(pending, results)
+            while ready:
+                for name in ready:
+                    if not schedule(name):
+                        continue
+                    job = pending.pop(name)
+                    running[pool.submit(_execute, job.fun, job.args, job.kwargs, job.name, job.labels)] = name
+                # Skipped jobs may unlock further jobs right away
+                ready = _ready(pending, results)
+            if not running:
+                if pending:
+                    raise RuntimeError(f"Circular dependencies between jobs: {sorted(pending)}")
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                manifest.update(name, keys[name])
+    return results
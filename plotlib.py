@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import pickle
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from tracelib import span, written
+
+pjoin = os.path.join
+
+# Directory the plot specs are queued in, None disables plotting.
+# Set before any worker is forked, so the workers inherit it.
+_queue_dir = None
+
+def configure(queue_dir):
+    global _queue_dir
+    _queue_dir = queue_dir
+    if queue_dir is not None:
+        os.makedirs(queue_dir, exist_ok=True)
+
+def enabled():
+    return _queue_dir is not None
+
+class AxesRecorder():
+    '''
+    Stand-in for a matplotlib Axes that records all method calls.
+
+    The calls are replayed on real axes by the renderer.
+    Nothing is recorded while plotting is disabled.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kwargs):
+            if _queue_dir is None:
+                return
+            self.calls.append((name, args, kwargs))
+        return record
+
+class PlotSpec():
+    '''
+    Numeric content and style of a ratio plot, without any matplotlib objects.
+    '''
+    def __init__(self):
+        self.ax = AxesRecorder()
+        self.rax = AxesRecorder()
+        self.path = None
+        self.save_kwargs = {}
+
+    def savefig(self, path, **kwargs):
+        '''
+        Queues the plot for rendering instead of drawing it.
+        '''
+        self.path = path
+        self.save_kwargs = kwargs
+        emit(self)
+
+def fig_ratio():
+    '''
+    Same interface as bucoffea.plot.util.fig_ratio, returning recorders.
+    '''
+    spec = PlotSpec()
+    return spec, spec.ax, spec.rax
+
+def emit(spec):
+    if not enabled():
+        return
+    path = pjoin(_queue_dir, f"{uuid.uuid4().hex}.pkl")
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(spec, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    written(path)
+
+def render(spec):
+    from bucoffea.plot.style import matplotlib_rc
+    from bucoffea.plot.util import fig_ratio as mpl_fig_ratio
+    from matplotlib import pyplot as plt
+
+    with span("render", path=spec.path):
+        matplotlib_rc()
+        fig, ax, rax = mpl_fig_ratio()
+        for axes, recorder in [(ax, spec.ax), (rax, spec.rax)]:
+            for name, args, kwargs in recorder.calls:
+                getattr(axes, name)(*args, **kwargs)
+        fig.savefig(spec.path, **spec.save_kwargs)
+        plt.close(fig)
+    written(spec.path)
+
+def _render_file(path):
+    with open(path, "rb") as f:
+        spec = pickle.load(f)
+    render(spec)
+    os.remove(path)
+    return spec.path
+
+def render_queue(queue_dir, njobs=1):
+    '''
+    Renders all queued plot specs, in a process pool if njobs > 1.
+    '''
+    files = sorted(pjoin(queue_dir, x) for x in os.listdir(queue_dir) if x.endswith(".pkl"))
+    if njobs <= 1:
+        return [_render_file(x) for x in files]
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=njobs, mp_context=ctx) as pool:
+        return list(pool.map(_render_file, files))
@@ -0,0 +1,349 @@
+import os
+
+import numpy as np
+
+from fitlib import FitResult, get_model, variation_names
+from tracelib import written
+
+def split_tag(tag):
+    '''
+    Splits a job tag like "closure_0p2_bin_alt1" into ("closure_0p2", "alt1").
+    '''
+    name, _, bintag = tag.rpartition("_bin_")
+    return name, bintag
+
+def atomic_save(path, array):
+    tmp = f"{path}.tmp{os.getpid()}.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+    written(path)
+
+def toys_path(path):
+    return os.path.splitext(path)[0] + "_toys.npy"
+
+def fit_record(year, tag, fit):
+    '''
+    Plain description of a fitted TFFit or FitResult, independent of pickled functions.
+    '''
+    model = get_model(fit.fun)
+    if model is None:
+        raise ValueError(f"Only registered models can be stored, got {fit.fun}")
+    name, bintag = split_tag(tag)
+    pars = fit.pars
+    return dict(
+        year=year,
+        tag=name,
+        bintag=bintag,
+        model=model.name,
+        npoint=fit.npoint,
+        chi2=getattr(fit, 'chi2', np.nan),
+        parameters=np.array([pars[key] for key in variation_names(model.npar)]),
+        covariance=getattr(fit, 'pcov', np.full((model.npar, model.npar), np.nan)),
+        toys=getattr(fit, 'toy_parameters', np.zeros((0, model.npar))),
+        nfev=getattr(fit, 'nfev', 0),
+        nfev_p0=getattr(fit, 'nfev_p0', 0),
+        start=getattr(fit, 'start', ''),
+    )
+
+def write_fit_store(path, records):
+    '''
+    Writes fit records into one structured array, memory-mappable with np.load.
+
+    Parameters of models with fewer parameters are padded with nan.
+    Toy parameters of all fits go into a separate array, referenced by offset.
+    '''
+    npar = max([get_model(r['model']).npar for r in records], default=1)
+    dtype = [
+        ('year', 'i4'),
+        ('tag', 'U64'),
+        ('bintag', 'U64'),
+        ('model', 'U32'),
+        ('npar', 'i4'),
+        ('npoint', 'i4'),
+        ('chi2', 'f8'),
+        ('parameters', 'f8', (2*npar+1, npar)),
+        ('covariance', 'f8', (npar, npar)),
+        ('toy_offset', 'i8'),
+        ('ntoys', 'i8'),
+        ('nfev', 'i4'),
+        ('nfev_p0', 'i4'),
+        ('start', 'U32'),
+    ]
+    table = np.zeros(len(records), dtype=dtype)
+    table['parameters'] = np.nan
+    table['covariance'] = np.nan
+    toys = []
+    offset = 0
+    for i, r in enumerate(records):
+        n = get_model(r['model']).npar
+        row = table[i]
+        for key in ['year', 'tag', 'bintag', 'model', 'npoint', 'chi2']:
+            row[key] = r[key]
+        row['nfev'] = r.get('nfev', 0)
+        row['nfev_p0'] = r.get('nfev_p0', 0)
+        row['start'] = r.get('start', '')
+        row['npar'] = n
+        row['parameters'][:2*n+1, :n] = r['parameters']
+        row['covariance'][:n, :n] = r['covariance']
+        row['toy_offset'] = offset
+        row['ntoys'] = len(r['toys'])
+        padded = np.full((len(r['toys']), npar), np.nan)
+        padded[:, :n] = r['toys']
+        toys.append(padded)
+        offset += len(r['toys'])
+
+    atomic_save(path, table)
+    if offset:
+        atomic_save(toys_path(path), np.concatenate(toys))
+    elif os.path.exists(toys_path(path)):
+        os.remove(toys_path(path))
+
+def read_records(path):
+    '''
+    Inverse of write_fit_store.
+    '''
+    store = FitStore(path)
+    names = store.table.dtype.names
+    records = []
+    for row in store.table:
+        n = int(row['npar'])
+        records.append(dict(
+            year=int(row['year']),
+            tag=str(row['tag']),
+            bintag=str(row['bintag']),
+            model=str(row['model']),
+            npoint=int(row['npoint']),
+            chi2=float(row['chi2']),
+            parameters=np.array(row['parameters'][:2*n+1, :n]),
+            covariance=np.array(row['covariance'][:n, :n]),
+            toys=np.array(store.toys(row)),
+            # Not present in stores written before warm starts
+            nfev=int(row['nfev']) if 'nfev' in names else 0,
+            nfev_p0=int(row['nfev_p0']) if 'nfev_p0' in names else 0,
+            start=str(row['start']) if 'start' in names else '',
+        ))
+    return records
+
+def merge_fit_stores(paths, path):
+    '''
+    Combines per-tag fit stores into a single store.
+    '''
+    records = []
+    for part in paths:
+        records.extend(read_records(part))
+    write_fit_store(path, records)
+
+class FitStore():
+    '''
+    Read-only access to a fit store, indexed by (year, tag, bintag).
+
+    The store is memory-mapped, with mmap_mode=None it is read completely.
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        self.table = np.load(path, mmap_mode=mmap_mode)
+        self._toys = None
+        if os.path.exists(toys_path(path)):
+            self._toys = np.load(toys_path(path), mmap_mode=mmap_mode)
+        self.index = {}
+        for i, (year, tag, bintag) in enumerate(zip(self.table['year'], self.table['tag'], self.table['bintag'])):
+            self.index[(int(year), str(tag), str(bintag))] = i
+
+    def toys(self, row):
+        n = int(row['npar'])
+        start = int(row['toy_offset'])
+        return self._toys[start:start+int(row['ntoys']), :n] if row['ntoys'] else np.zeros((0, n))
+
+    def bintags(self, year, tag):
+        return [b for (y, t, b) in self.index if y == year and t == tag]
+
+    def get(self, year, tag, bintag):
+        '''
+        FitResult with the stored parameters.
+
+        The input points are not stored, only evaluation is possible.
+        '''
+        row = self.table[self.index[(year, tag, bintag)]]
+        n = int(row['npar'])
+        return FitResult(
+            str(row['model']),
+            row['parameters'][:2*n+1, :n],
+            covariance=row['covariance'][:n, :n],
+            chi2=row['chi2'],
+            npoint=row['npoint'],
+            toy_parameters=self.toys(row) if row['ntoys'] else None,
+            )
+
+    def fits(self, year, tag):
+        '''
+        All fits for one year and tag, keyed by bintag.
+        '''
+        return {bintag : self.get(year, tag, bintag) for bintag in self.bintags(year, tag)}
+
+class StoredHist():
+    '''
+    Flow-inclusive 1D histogram with the uproot TH1 accessors used by the stages.
+
+    The arrays are views into the store and must not be modified.
+    '''
+    def __init__(self, edges, sumw, sumw2):
+        self.edges = edges
+        self.allvalues = sumw
+        self.allvariances = sumw2
+
+    @property
+    def allbins(self):
+        return np.stack([np.r_[-np.inf, self.edges], np.r_[self.edges, np.inf]], axis=1)
+
+def template_record(tag, year, name, edges, sumw, sumw2):
+    '''
+    A single histogram; sumw and sumw2 include under- and overflow.
+    '''
+    return dict(tag=tag, year=year, name=name, edges=np.asarray(edges, dtype=float), sumw=sumw, sumw2=sumw2)
+
+def write_template_store(path, records):
+    '''
+    Writes all histograms in one batch into a structured array, memory-mappable with np.load.
+
+    Shorter histograms are padded, the number of edges is stored per row.
+    '''
+    nedges = max([len(r['edges']) for r in records], default=1)
+    dtype = [
+        ('tag', 'U64'),
+        ('year', 'i4'),
+        ('name', 'U128'),
+        ('nedges', 'i4'),
+        ('edges', 'f8', (nedges,)),
+        ('sumw', 'f8', (nedges+1,)),
+        ('sumw2', 'f8', (nedges+1,)),
+    ]
+    table = np.zeros(len(records), dtype=dtype)
+    for i, r in enumerate(records):
+        n = len(r['edges'])
+        table['tag'][i] = r['tag']
+        table['year'][i] = r['year']
+        table['name'][i] = r['name']
+        table['nedges'][i] = n
+        table['edges'][i, :n] = r['edges']
+        table['sumw'][i, :n+1] = r['sumw']
+        table['sumw2'][i, :n+1] = r['sumw2']
+    atomic_save(path, table)
+
+def merge_template_stores(paths, path):
+    '''
+    Combines per-tag template stores into a single store.
+    '''
+    records = []
+    for part in paths:
+        store = TemplateStore(part)
+        for (tag, name), i in store.index.items():
+            h = store.get(tag, name)
+            records.append(template_record(tag, int(store.table['year'][i]), name, h.edges, h.allvalues, h.allvariances))
+    write_template_store(path, records)
+
+class TemplateStore():
+    '''
+    Read-only access to a template store, indexed by (tag, name).
+
+    Histograms are returned as zero-copy views into the memory-mapped table.
+    With mmap_mode=None the table is read completely.
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        self.table = np.load(path, mmap_mode=mmap_mode)
+        self.index = {}
+        for i, (tag, name) in enumerate(zip(self.table['tag'], self.table['name'])):
+            self.index[(str(tag), str(name))] = i
+
+    def tags(self):
+        return list(dict.fromkeys(tag for tag, _ in self.index))
+
+    def get(self, tag, name):
+        i = self.index[(tag, name)]
+        n = int(self.table['nedges'][i])
+        return StoredHist(
+            self.table['edges'][i, :n],
+            self.table['sumw'][i, :n+1],
+            self.table['sumw2'][i, :n+1],
+        )
+
+    def view(self, tag):
+        '''
+        Dict-like access to the histograms of one tag, like the per-tag ROOT files.
+        '''
+        return TemplateView(self, tag)
+
+class TemplateView():
+    def __init__(self, store, tag):
+        self.store = store
+        self.tag = tag
+
+    def __getitem__(self, name):
+        return self.store.get(self.tag, name)
+
+    def keys(self):
+        return [name for tag, name in self.store.index if tag == self.tag]
+
+def export_templates_root(path, outdir, region):
+    '''
+    Writes the content of a template store into one ROOT file per tag,
+    with the same layout as the original templates_{region}_{tag}.root files.
+    '''
+    import uproot
+    from bucoffea.plot.util import URTH1
+
+    store = TemplateStore(path)
+    for tag in store.tags():
+        view = store.view(tag)
+        f = uproot.recreate(os.path.join(outdir, f"templates_{region}_{tag}.root"))
+        for name in view.keys():
+            h = view[name]
+            f[name] = URTH1(edges=np.array(h.edges), sumw=np.array(h.allvalues), sumw2=np.array(h.allvariances))
+        f.close()
+        written(os.path.join(outdir, f"templates_{region}_{tag}.root"))
+
+class PredictionWriter():
+    '''
+    Collects the shapes of the final prediction and writes them to one ROOT file in a single pass.
+
+    Every shape goes into a directory, e.g. one per region, so that the
+    regions keep their shape and nuisance names. Shapes with the same
+    binning share one edges array.
+    '''
+    def __init__(self):
+        self.edges = {}
+        self.shapes = {}
+
+    def add(self, name, edges, sumw, sumw2=None, directory=''):
+        key = f"{directory}/{name}" if directory else name
+        if key in self.shapes:
+            raise ValueError(f"Duplicate prediction shape {key}")
+        edges = np.asarray(edges, dtype=float)
+        edges = self.edges.setdefault(edges.tobytes(), edges)
+        sumw = np.asarray(sumw, dtype=float)
+        sumw2 = np.zeros_like(sumw) if sumw2 is None else np.asarray(sumw2, dtype=float)
+        self.shapes[key] = (edges, sumw, sumw2)
+
+    def add_store(self, path, directory=''):
+        '''
+        Adds all histograms of a template store.
+        '''
+        store = TemplateStore(path)
+        for tag, name in store.index:
+            h = store.get(tag, name)
+            self.add(name, h.edges, h.allvalues, h.allvariances, directory=directory)
+
+    def write(self, path):
+        '''
+        Writes all shapes into a temporary file, which is then renamed,
+        so readers never see a partial file.
+        '''
+        import uproot
+        from bucoffea.plot.util import URTH1
+
+        tmp = f"{os.path.splitext(path)[0]}.tmp{os.getpid()}.root"
+        f = uproot.recreate(tmp)
+        # Keys with a slash are created in the corresponding directory
+        for key, (edges, sumw, sumw2) in sorted(self.shapes.items()):
+            f[key] = URTH1(edges=edges, sumw=sumw, sumw2=sumw2)
+        f.close()
+        os.replace(tmp, path)
+        written(path)
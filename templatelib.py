@@ -0,0 +1,267 @@
+import hashlib
+import re
+
+import numpy as np
+
+# Dataset groups entering the estimate, overridden by the config.
+# Each group is a list of patterns, formatted with the year before matching.
+GROUPS = {
+    'qcd'    : ['QCD.*HT.*{year}'],
+    'nonqcd' : [
+        'ZJetsToNuNu.*{year}',
+        'Top_FXFX.*{year}',
+        'Diboson.*{year}',
+        '.*DYJetsToLL_M-50_HT_MLM.*{year}',
+        '.*WJetsToLNu.*HT.*{year}',
+    ],
+    'data'   : ['MET_{year}'],
+}
+
+def dataset_index(datasets, groups, years):
+    '''
+    Matches every dataset name once against the group patterns.
+
+    Returns two aligned integer arrays: positions in datasets and the flat
+    group*len(years)+year index they contribute to. A dataset can enter more
+    than one group, datasets in no group are left out.
+    '''
+    rows = []
+    targets = []
+    for igroup, patterns in enumerate(groups.values()):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        for iyear, year in enumerate(years):
+            regex = re.compile('|'.join(f"(?:{p.format(year=year)})" for p in patterns))
+            for idataset, name in enumerate(datasets):
+                if regex.match(name):
+                    rows.append(idataset)
+                    targets.append(igroup*len(years) + iyear)
+    return np.array(rows, dtype=int), np.array(targets, dtype=int)
+
+def hist_index(h, groups, years):
+    '''
+    dataset_index for the dataset axis of a coffea histogram.
+
+    Returns (datasets, rows, targets), the dataset names are kept so that
+    a stored index can be checked against the histogram it is used with.
+    '''
+    datasets = [str(x) for x in h.identifiers('dataset')]
+    return (datasets,) + dataset_index(datasets, groups, years)
+
+def flow_centers(edges):
+    '''
+    Bin centers of an axis including the under-, over- and nan-flow bins,
+    in the same order as coffea uses for overflow="allnan".
+    '''
+    edges = np.asarray(edges, dtype=float)
+    return np.r_[-np.inf, 0.5*(edges[1:]+edges[:-1]), np.inf, np.nan]
+
+def rebin_map(fine_edges, bins):
+    '''
+    Maps every flow-inclusive fine bin onto the flow-inclusive new binning.
+
+    As in coffea's rebin, a fine bin ends up in the new bin containing its center.
+    '''
+    bins = np.asarray(bins, dtype=float)
+    centers = flow_centers(fine_edges)
+    idx = np.searchsorted(bins, centers, side='right')
+    idx[np.isnan(centers)] = len(bins) + 1
+    return idx
+
+def slice_indices(edges, the_slice):
+    '''
+    Converts a value slice into an index range on the flow-inclusive axis.
+
+    Mirrors coffea's integrate(): an open start includes the underflow,
+    an open stop includes the overflow and nan-flow bins.
+    '''
+    edges = np.asarray(edges, dtype=float)
+    lo = 0
+    hi = len(edges) + 2
+    if the_slice.start is not None:
+        lo = int(np.searchsorted(edges, the_slice.start, side='right'))
+    if the_slice.stop is not None:
+        hi = int(np.searchsorted(edges, the_slice.stop, side='right'))
+    return lo, hi
+
+def cumsum0(array, axis=-1):
+    '''
+    Cumulative sum along an axis with a leading zero,
+    so that sum(array[lo:hi]) == c[hi] - c[lo].
+    '''
+    shape = list(array.shape)
+    shape[axis] = 1
+    return np.concatenate([np.zeros(shape), np.cumsum(array, axis=axis)], axis=axis)
+
+class QCDTensor():
+    '''
+    Dense recoil vs dphi arrays for all regions, dataset groups and years.
+
+    sumw and sumw2 have the shape (region, group, year, recoil, dphi), where
+    both dense axes include the flow bins. All templates for any recoil binning
+    and dphi selection are derived from these arrays without touching the
+    original coffea histogram again.
+    '''
+    def __init__(self, regions, groups, years, recoil_edges, dphi_edges, sumw, sumw2):
+        self.regions = list(regions)
+        self.groups = list(groups)
+        self.years = list(years)
+        self.recoil_edges = np.asarray(recoil_edges, dtype=float)
+        self.dphi_edges = np.asarray(dphi_edges, dtype=float)
+        self.sumw = sumw
+        self.sumw2 = sumw2
+        self._csumw = None
+        self._csumw2 = None
+
+    @classmethod
+    def from_hist(cls, h, regions, years, groups=GROUPS, index=None):
+        '''
+        Reads a coffea recoil vs dphi histogram with dataset and region axes.
+
+        All regions, groups and years are filled in a single sweep over the
+        histogram's own arrays, so further regions cost almost nothing.
+        index is the output of hist_index for h, it is computed if not given.
+        A ValueError is raised if it was built for other datasets.
+        '''
+        recoil_edges = h.axis('recoil').edges()
+        dphi_edges = h.axis('dphi').edges()
+        shape = (len(regions), len(groups), len(years), len(recoil_edges)+2, len(dphi_edges)+2)
+        sumw = np.zeros(shape)
+        sumw2 = np.zeros(shape)
+
+        datasets = [str(x) for x in h.identifiers('dataset')]
+        if index is None:
+            index = hist_index(h, groups, years)
+        indexed, rows, targets = index
+        if list(indexed) != datasets:
+            raise ValueError("The dataset index does not match the datasets of the histogram")
+
+        transpose = [ax.name for ax in h.dense_axes()] == ['dphi', 'recoil']
+        sparse = [ax.name for ax in h.sparse_axes()]
+        idataset, iregion = sparse.index('dataset'), sparse.index('region')
+
+        # Stacked flow-inclusive arrays of every requested region, in a flat
+        # (dataset, region) slot. values() returns views, so the histogram is not copied,
+        # and sumw for sumw2 of unweighted histograms.
+        position = {name : i for i, name in enumerate(datasets)}
+        w = np.zeros((len(datasets)*len(regions),) + shape[3:])
+        w2 = np.zeros_like(w)
+        for key, (kw, kw2) in h.values(sumw2=True, overflow='allnan').items():
+            if str(key[iregion]) not in regions:
+                continue
+            i = position[str(key[idataset])]*len(regions) + regions.index(str(key[iregion]))
+            w[i] = kw.T if transpose else kw
+            w2[i] = kw2.T if transpose else kw2
+
+        # Every (dataset, group, year) match for all regions in one reduction
+        ngroupyear = len(groups) * len(years)
+        ireg = np.arange(len(regions))
+        src = (rows[:, None]*len(regions) + ireg[None, :]).ravel()
+        dst = (ireg[None, :]*ngroupyear + targets[:, None]).ravel()
+        np.add.at(sumw.reshape((-1,) + shape[3:]), dst, w[src])
+        np.add.at(sumw2.reshape((-1,) + shape[3:]), dst, w2[src])
+
+        return cls(regions, groups, years, recoil_edges, dphi_edges, sumw, sumw2)
+
+    def fingerprint(self, region=None, year=None):
+        '''
+        Content hash of the arrays, optionally restricted to a single region and/or year.
+        '''
+        regions = self.regions if region is None else [region]
+        years = self.years if year is None else [year]
+        ireg = [self.regions.index(x) for x in regions]
+        iyear = [self.years.index(x) for x in years]
+
+        sha = hashlib.sha256()
+        sha.update(repr((regions, self.groups, years)).encode())
+        arrays = [self.recoil_edges, self.dphi_edges]
+        arrays += [self.sumw[ireg][:, :, iyear], self.sumw2[ireg][:, :, iyear]]
+        for array in arrays:
+            sha.update(np.ascontiguousarray(array).tobytes())
+        return sha.hexdigest()
+
+    def add(self, other):
+        '''
+        Adds the content of another tensor with the same axes, in place.
+        '''
+        same = (self.regions, self.groups, self.years) == (other.regions, other.groups, other.years)
+        if not same or not np.array_equal(self.recoil_edges, other.recoil_edges) or not np.array_equal(self.dphi_edges, other.dphi_edges):
+            raise ValueError("Cannot add QCDTensors with different axes")
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self._csumw = None
+        self._csumw2 = None
+
+    def _cumulative(self):
+        if self._csumw is None:
+            self._csumw = cumsum0(self.sumw, axis=-1)
+            self._csumw2 = cumsum0(self.sumw2, axis=-1)
+        return self._csumw, self._csumw2
+
+    def rebin_matrix(self, bins):
+        '''
+        One-hot matrix rebinning the fine flow-inclusive recoil axis
+        into the flow-inclusive new binning (without nan-flow).
+        '''
+        idx = rebin_map(self.recoil_edges, bins)
+        matrix = np.zeros((len(idx), len(bins)+1))
+        keep = idx < len(bins) + 1
+        matrix[np.arange(len(idx))[keep], idx[keep]] = 1
+        return matrix
+
+    def project(self, region, year, bins, dphi, matrix=None):
+        '''
+        Integrates a dphi slice and rebins recoil.
+
+        Returns sumw, sumw2 with shape (group, recoil), including
+        under- and overflow of the new binning.
+        '''
+        lo, hi = slice_indices(self.dphi_edges, dphi)
+        csumw, csumw2 = self._cumulative()
+        ireg = self.regions.index(region)
+        iyear = self.years.index(year)
+        if matrix is None:
+            matrix = self.rebin_matrix(bins)
+        sumw = (csumw[ireg, :, iyear, :, hi] - csumw[ireg, :, iyear, :, lo]) @ matrix
+        sumw2 = (csumw2[ireg, :, iyear, :, hi] - csumw2[ireg, :, iyear, :, lo]) @ matrix
+        return sumw, sumw2
+
+    def scan(self, region, year, bins, cuts, dphi_cut=0.5):
+        '''
+        CR and SR templates for many CR/SR boundaries at once.
+
+        The CR is dphi in (0, cut) and the SR dphi in (cut, dphi_cut), each a
+        difference of the cumulative sums. Returns cr_sumw, cr_sumw2, sr_sumw, sr_sumw2
+        with the shape (cut, group, recoil), including under- and overflow.
+        '''
+        start, _ = slice_indices(self.dphi_edges, slice(0., None))
+        _, stop = slice_indices(self.dphi_edges, slice(None, dphi_cut))
+        mid = np.array([slice_indices(self.dphi_edges, slice(None, cut))[1] for cut in cuts])
+        csumw, csumw2 = self._cumulative()
+        ireg = self.regions.index(region)
+        iyear = self.years.index(year)
+        matrix = self.rebin_matrix(bins)
+
+        ret = []
+        for c in (csumw[ireg, :, iyear], csumw2[ireg, :, iyear]):
+            # (group, recoil, cut) -> (cut, group, recoil)
+            at_mid = np.moveaxis(c[:, :, mid], -1, 0)
+            cr = (at_mid - c[None, :, :, start]) @ matrix
+            sr = (c[None, :, :, stop] - at_mid) @ matrix
+            ret.append((cr, sr))
+        (cr_sumw, sr_sumw), (cr_sumw2, sr_sumw2) = ret
+        return cr_sumw, cr_sumw2, sr_sumw, sr_sumw2
+
+    def templates(self, region, year, bins, dphi_cr=slice(0.0,0.5), dphi_sr=slice(0.5,None)):
+        '''
+        CR and SR templates for all groups of one region and year.
+
+        Returns a dict mapping e.g. ("cr", "qcd") to (sumw, sumw2).
+        '''
+        matrix = self.rebin_matrix(bins)
+        ret = {}
+        for selection, dphi in [("cr", dphi_cr), ("sr", dphi_sr)]:
+            sumw, sumw2 = self.project(region, year, bins, dphi, matrix=matrix)
+            for igroup, name in enumerate(self.groups):
+                ret[(selection, name)] = sumw[igroup], sumw2[igroup]
+        return ret
@@ -0,0 +1,48 @@
+import numpy as np
+
+from binninglib import bin_quality, greedy_binning, pareto_front
+
+EDGES = np.arange(0., 11.)
+
+def contents(sumw):
+    '''
+    Unweighted CR and SR contents, sumw2 equals sumw.
+    '''
+    sumw = np.asarray(sumw, dtype=float)
+    return sumw, sumw, sumw, sumw
+
+def test_greedy_binning_satisfies_constraints():
+    sumw = np.array([50, 40, 30, 20, 10, 8, 6, 4, 2, 1])
+    bins = greedy_binning(EDGES, *contents(sumw), min_neff=20, max_rel_unc=0.5)
+    assert bins[0] == EDGES[0] and bins[-1] == EDGES[-1]
+    merged = np.add.reduceat(sumw, np.searchsorted(EDGES, bins[:-1]))
+    neff, rel_unc = bin_quality(*contents(merged))
+    assert np.all(neff >= 20)
+    assert np.all(rel_unc <= 0.5)
+    # The remainder 7-10 is merged into the bin 4-7
+    assert list(bins) == [0, 1, 2, 3, 4, 10]
+
+def test_greedy_binning_merges_remainder():
+    # The last two bins never reach min_neff on their own
+    sumw = np.array([30, 30, 30, 1, 1])
+    bins = greedy_binning(EDGES[:6], *contents(sumw), min_neff=20, max_rel_unc=1)
+    assert list(bins) == [0, 1, 2, 5]
+
+def test_greedy_binning_single_bin():
+    sumw = np.ones(10)
+    bins = greedy_binning(EDGES, *contents(sumw), min_neff=100, max_rel_unc=1)
+    assert list(bins) == [0, 10]
+
+def test_pareto_front():
+    objectives = np.array([
+        [1, 5],
+        [2, 2],
+        [5, 1],
+        [3, 3], # dominated by [2, 2]
+        [2, 2], # equal points do not dominate each other
+        [1, 6], # dominated by [1, 5], equal in the first objective
+    ])
+    assert list(pareto_front(objectives)) == [True, True, True, False, True, False]
+
+def test_pareto_front_single_objective():
+    assert list(pareto_front([[3], [1], [2], [1]])) == [False, True, False, True]
@@ -0,0 +1,49 @@
+import sys
+
+import pytest
+
+from configlib import OPTIMIZE, load_config
+
+TOML = '''
+indir = "./input/test"
+distribution = "recoil_vs_dphi_qcd"
+years = [2017]
+regions = ["cr_qcd_j"]
+dphi_cut = 0.5
+closure_cuts = [0.2]
+
+[fit]
+model = "exponential"
+p0 = [0.5, 1.0e-2, 0]
+
+[bins.cr_qcd_j]
+nom = [250, 300, 400, 1400]
+'''
+
+def write_toml(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text(TOML)
+    return str(path)
+
+def test_load_toml(tmp_path):
+    config = load_config(write_toml(tmp_path))
+    assert config['bins']['cr_qcd_j']['nom'] == [250, 300, 400, 1400]
+    assert config['outdir'] == './output/test'
+
+def test_load_toml_without_tomllib(tmp_path, monkeypatch):
+    pytest.importorskip("toml")
+    # Makes "import tomllib" fail like on python < 3.11
+    monkeypatch.setitem(sys.modules, "tomllib", None)
+    config = load_config(write_toml(tmp_path))
+    assert config['fit']['model'] == 'exponential'
+
+def test_optimize_defaults_are_merged(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text(TOML + '''
+[optimize]
+chunks = 2
+''')
+    config = load_config(str(path))
+    assert config['optimize']['chunks'] == 2
+    assert config['optimize']['min_neff'] == OPTIMIZE['min_neff']
+    assert config['optimize']['max_rel_unc'] == OPTIMIZE['max_rel_unc']
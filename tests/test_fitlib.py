@@ -0,0 +1,185 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from fitlib import BatchTFFit, TFFit, exponential, get_model
+
+def unregistered(x, a, b):
+    return a * np.exp(-b * x)
+
+def test_get_model_unknown_name():
+    with pytest.raises(ValueError, match="nonexistent"):
+        get_model("nonexistent")
+
+def test_unregistered_model_without_p0():
+    x = np.linspace(250, 1000, 5)
+    with pytest.raises(ValueError, match="unregistered"):
+        TFFit(x, x, x, unregistered)
+    with pytest.raises(ValueError, match="unregistered"):
+        BatchTFFit(x, x, x, unregistered)
+
+def test_unregistered_model_with_p0():
+    fit = TFFit(np.zeros(3), np.zeros(3), np.ones(3), unregistered, p0=(1, 0))
+    assert fit.p0 == (1, 0)
+
+def make_fit():
+    x = np.linspace(250, 1400, 12)
+    y = 0.5*np.exp(-1e-2*x) + 0.01
+    fit = TFFit(x, y, 0.05*y, exponential)
+    fit.fit()
+    return fit
+
+def test_pars_are_read_only():
+    fit = make_fit()
+    with pytest.raises(ValueError):
+        fit.pars['best'][0] = 1.
+    with pytest.raises(TypeError):
+        fit.pars['best'] = np.zeros(3)
+    with pytest.raises(ValueError):
+        fit.parameters[0, 0] = 1.
+
+def test_assigning_pars_resets_memo():
+    fit = make_fit()
+    x = np.linspace(200, 1500, 20)
+    before = fit.evaluate(x)
+    pars = dict(fit.pars)
+    pars['best'] = pars['best'] * [2, 1, 1]
+    fit.pars = pars
+    assert np.allclose(fit.evaluate(x), 2*before - fit.pars['best'][2])
+
+def test_evaluate_returns_writable_copies():
+    fit = make_fit()
+    x = np.linspace(200, 1500, 20)
+    first = fit.evaluate(x)
+    first *= 0
+    assert np.all(fit.evaluate(x) > 0)
+    array = fit.evaluate_array(x)
+    array[:] = 0
+    assert np.all(fit.evaluate_array(x) > 0)
+    for values in fit.evaluate_all(x).values():
+        values[:] = 0
+    assert np.all(fit.envelope(x)[0] > 0)
+
+@pytest.mark.parametrize("name", ["exponential", "exponential2"])
+def test_guess_converges_to_same_minimum(name):
+    model = get_model(name)
+    x = np.linspace(250, 1400, 12)
+    y = 0.5*np.exp(-4e-3*x) + 0.01
+    dy = 0.05*y
+    guess = model.guess(x, y, dy)
+    assert len(guess) == model.npar
+    cold = TFFit(x, y, dy, model.fun, p0=model.p0)
+    cold.fit()
+    warm = TFFit(x, y, dy, model.fun, p0=guess)
+    warm.fit()
+    assert np.allclose(warm.pars['best'], cold.pars['best'], rtol=1e-4, atol=1e-6)
+
+def test_guess_without_positive_points():
+    x = np.linspace(250, 1400, 12)
+    assert get_model("exponential").guess(x, np.zeros_like(x), np.ones_like(x)) is None
+
+def test_fit_result_follows_the_same_contract():
+    result = make_fit().result()
+    x = np.linspace(200, 1500, 20)
+    with pytest.raises(ValueError):
+        result.pars['best'][0] = 1.
+    with pytest.raises(TypeError):
+        result.pars['best'] = np.zeros(3)
+    first = result.evaluate(x)
+    first *= 0
+    assert np.all(result.evaluate(x) > 0)
+    array = result.evaluate_array(x)
+    array[:] = 0
+    assert np.all(result.envelope(x)[0] > 0)
+    restored = pickle.loads(pickle.dumps(result))
+    assert np.array_equal(restored.evaluate(x), result.evaluate(x))
+    with pytest.raises(ValueError):
+        restored.parameters[0, 0] = 1.
+
+def problems():
+    '''
+    Noisy TF points of different lengths. The constant term of the last one
+    and the quadratic term of exponential2 fit best at their lower bound of zero.
+    '''
+    rng = np.random.default_rng(3)
+    ret = []
+    for npoint, y in [
+        (12, lambda x: 0.5*np.exp(-4e-3*x) + 0.01),
+        (9, lambda x: 0.3*np.exp(-3e-3*x) + 0.02),
+        # A negative offset, the constant term wants to be negative
+        (10, lambda x: 0.5*np.exp(-3e-3*x) - 0.003),
+    ]:
+        x = np.linspace(250, 1400, npoint)
+        dy = 0.05 * y(x)
+        ret.append((x, y(x) + dy * rng.standard_normal(npoint), dy))
+    return ret
+
+@pytest.mark.parametrize("name", ["exponential", "exponential2"])
+def test_batch_matches_curve_fit(name):
+    model = get_model(name)
+    inputs = problems()
+    npoint = max(len(x) for x, _, _ in inputs)
+    x = np.zeros((len(inputs), npoint))
+    y = np.ones((len(inputs), npoint))
+    dy = np.ones((len(inputs), npoint))
+    mask = np.zeros((len(inputs), npoint), dtype=bool)
+    for i, (xi, yi, dyi) in enumerate(inputs):
+        n = len(xi)
+        x[i, :n], y[i, :n], dy[i, :n], mask[i, :n] = xi, yi, dyi, True
+    batch = BatchTFFit(x, y, dy, model.fun, mask=mask)
+    batch.fit()
+    assert np.all(batch.converged)
+
+    at_bound = False
+    for i, (xi, yi, dyi) in enumerate(inputs):
+        fit = TFFit(xi, yi, dyi, model.fun)
+        fit.fit()
+        best = fit.pars['best']
+        scale = np.abs(best) + 1e-6*np.abs(best).max()
+        assert batch.chi2[i] == pytest.approx(fit.chi2, rel=1e-5, abs=1e-8)
+        assert np.all(np.abs(batch.pars['best'][i] - best) < 1e-3 * scale)
+        assert np.allclose(batch.pcov[i], fit.pcov, rtol=1e-2, atol=1e-3*np.abs(fit.pcov).max())
+        at_bound |= np.any(batch.pars['best'][i] == 0)
+    assert at_bound
+
+@pytest.mark.parametrize("name", ["exponential", "exponential2"])
+def test_jacobian_matches_finite_differences(name):
+    model = get_model(name)
+    x = np.linspace(250, 1400, 12)
+    p = np.array([0.5, 4e-3, 1e-6, 0.01][:model.npar])
+    jac = model.jac(x, *p)
+    assert jac.shape == (len(x), model.npar)
+    for i in range(model.npar):
+        h = 1e-5 * abs(p[i])
+        up, dn = p.copy(), p.copy()
+        up[i] += h
+        dn[i] -= h
+        numeric = (model.fun(x, *up) - model.fun(x, *dn)) / (2*h)
+        assert np.allclose(jac[:, i], numeric, rtol=1e-5, atol=1e-9)
+
+def test_toys_are_reproducible():
+    fit = make_fit()
+    fit.fit_toys(ntoys=200, seed=7)
+    first = fit.toy_parameters
+    fit.fit_toys(ntoys=200, seed=7)
+    assert np.array_equal(fit.toy_parameters, first)
+    fit.fit_toys(ntoys=200, seed=8)
+    assert not np.array_equal(fit.toy_parameters, first)
+
+@pytest.mark.parametrize("method", ["gauss", "poisson"])
+def test_toy_envelope_brackets_best_fit(method):
+    fit = make_fit()
+    fit.fit_toys(ntoys=500, seed=1, method=method)
+    # Nearly all toys converge, with positive parameters within the bounds
+    assert fit.toy_parameters.shape[0] > 450
+    assert fit.toy_parameters.shape[1] == 3
+    assert np.all(fit.toy_parameters >= 0)
+    x = np.linspace(250, 1400, 20)
+    lo, hi = fit.toy_envelope(x)
+    best = fit.evaluate(x)
+    assert np.all(lo < best) and np.all(best < hi)
+
+def test_unknown_toy_method():
+    with pytest.raises(ValueError, match="binomial"):
+        make_fit().fit_toys(ntoys=10, method="binomial")
@@ -0,0 +1,8 @@
+import pytest
+
+from check_importtime import MODULES, problems
+
+@pytest.mark.parametrize("module", MODULES)
+def test_import_budget(module):
+    _, found = problems(module)
+    assert not found, "\n".join(found)
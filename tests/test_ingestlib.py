@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from ingestlib import base_dataset, normalization, stream_tensor, write_chunk
+
+DISTRIBUTION = 'recoil_vs_dphi_qcd'
+QCD = 'QCD_HT1000to1500-mg_new_pmx_2017'
+QCD_EXT = 'QCD_HT1000to1500-mg_new_pmx_ext1_2017'
+DATASETS = ['MET_2017C', 'MET_2017D', QCD]
+REGIONS = ['cr_qcd_j', 'cr_qcd_tight_v']
+
+def test_extensions_share_normalization():
+    assert base_dataset(QCD) == base_dataset(QCD_EXT) == 'QCD_HT1000to1500-mg_2017'
+    totals = {'sumw' : {QCD : 1., QCD_EXT : 3., 'MET_2017C' : 5.}, 'sumw_pileup' : {QCD : 2., QCD_EXT : 4.}}
+    assert dict(normalization(totals, False)) == {'QCD_HT1000to1500-mg_2017' : 4., 'MET_2017C' : 5.}
+    assert dict(normalization(totals, True)) == {'QCD_HT1000to1500-mg_2017' : 6.}
+
+def chunk(seed, datasets):
+    '''
+    Accumulator of one processing chunk with random fills for the given datasets.
+    '''
+    hist = pytest.importorskip("coffea.hist")
+    processor = pytest.importorskip("coffea.processor")
+    rng = np.random.default_rng(seed)
+    h = hist.Hist(
+                "Events",
+                hist.Cat("dataset", "Dataset"),
+                hist.Cat("region", "Region"),
+                hist.Bin("recoil", "Recoil (GeV)", np.linspace(0, 2000, 41)),
+                hist.Bin("dphi", r"$\Delta\phi$", np.linspace(0, np.pi, 17)),
+                )
+    sumw = processor.defaultdict_accumulator(float)
+    sumw_pileup = processor.defaultdict_accumulator(float)
+    nevents = processor.defaultdict_accumulator(float)
+    for dataset in datasets:
+        for region in REGIONS:
+            n = 500
+            h.fill(dataset=dataset, region=region, recoil=rng.exponential(300, n), dphi=rng.uniform(0, np.pi, n), weight=rng.uniform(0.5, 1.5, n))
+        sumw[dataset] += rng.uniform(1e3, 2e3)
+        sumw_pileup[dataset] += rng.uniform(1e3, 2e3)
+        nevents[dataset] += 1e3
+    return processor.dict_accumulator({
+        DISTRIBUTION : h,
+        'sumw' : sumw,
+        'sumw_pileup' : sumw_pileup,
+        'nevents' : nevents,
+    })
+
+@pytest.mark.parametrize("layout", [
+    # Every chunk fills every dataset
+    [DATASETS] * 3,
+    # One dataset or extension per chunk, as coffea writes them
+    [['MET_2017C'], ['MET_2017D'], [QCD], [QCD_EXT]],
+])
+def test_streamed_matches_merged(tmp_path, layout):
+    pytest.importorskip("klepto")
+    pytest.importorskip("bucoffea")
+    from klepto.archives import dir_archive
+
+    from data_driven_qcd import load_distribution
+    from templatelib import QCDTensor
+
+    chunks = [chunk(seed, datasets) for seed, datasets in enumerate(layout)]
+
+    # Chunked layout
+    chunked = str(tmp_path / "chunked")
+    for i, acc in enumerate(chunks):
+        write_chunk(chunked, f"chunk{i}", acc)
+
+    # Merged layout, keyed by accumulator name
+    merged = str(tmp_path / "merged")
+    total = chunks[0]
+    for acc in chunks[1:]:
+        total = total + acc
+    archive = dir_archive(merged, serialized=True, cached=False)
+    for key, value in total.items():
+        archive[key] = value
+
+    years = [2017]
+    for reweight_pu in [True, False]:
+        oneshot = QCDTensor.from_hist(load_distribution(merged, DISTRIBUTION, reweight_pu), REGIONS, years)
+        for indir in [chunked, merged]:
+            streamed = stream_tensor(indir, DISTRIBUTION, reweight_pu, REGIONS, years)
+            assert np.allclose(streamed.sumw, oneshot.sumw)
+            assert np.allclose(streamed.sumw2, oneshot.sumw2)
+        assert oneshot.sumw.sum() > 0
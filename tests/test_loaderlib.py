@@ -0,0 +1,29 @@
+import os
+
+import numpy as np
+
+from loaderlib import load
+from storelib import template_record, write_template_store
+
+def write(path, scale):
+    edges = [250., 300., 400.]
+    sumw = scale * np.array([0., 1., 2., 0.])
+    write_template_store(path, [template_record('nominal', 2017, 'h', edges, sumw, sumw)])
+
+def test_stores_stay_memory_mapped(tmp_path):
+    path = str(tmp_path / "templates.npy")
+    write(path, 1.)
+    store = load('templates', path)
+    assert isinstance(store.table, np.memmap)
+    assert load('templates', path) is store
+
+def test_rewritten_store_is_opened_again(tmp_path):
+    path = str(tmp_path / "templates.npy")
+    write(path, 1.)
+    first = load('templates', path)
+    write(path, 2.)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    second = load('templates', path)
+    assert second is not first
+    assert np.allclose(second.table['sumw'], 2 * first.table['sumw'])
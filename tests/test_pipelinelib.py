@@ -0,0 +1,27 @@
+from pipelinelib import Job, run_jobs, select_jobs
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+def graph(tmp_path, version):
+    a = str(tmp_path / "a.txt")
+    b = str(tmp_path / "b.txt")
+    return [
+        Job("a", write, args=(a, version), fingerprint=dict(version=version), outputs=[a], labels=dict(stage='a')),
+        Job("b", write, args=(b, "b"), deps=["a"], fingerprint={}, outputs=[b], labels=dict(stage='b')),
+    ]
+
+def test_deselected_dependency_keeps_key(tmp_path):
+    manifest = str(tmp_path / "manifest.json")
+    run_jobs(graph(tmp_path, "v1"), manifest=manifest)
+    run_jobs(select_jobs(graph(tmp_path, "v1"), stage=['b']), manifest=manifest)
+
+    # Nothing changed upstream, b is up to date
+    results = run_jobs(select_jobs(graph(tmp_path, "v1"), stage=['b']), manifest=manifest)
+    assert results == {"b" : None}
+
+    # A changed fingerprint of the deselected a invalidates b
+    results = run_jobs(select_jobs(graph(tmp_path, "v2"), stage=['b']), manifest=manifest)
+    assert results == {"b" : str(tmp_path / "b.txt")}
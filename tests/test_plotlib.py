@@ -0,0 +1,21 @@
+import os
+
+import plotlib
+
+def test_nothing_recorded_without_queue():
+    plotlib.configure(None)
+    fig, ax, rax = plotlib.fig_ratio()
+    ax.plot([1, 2], [3, 4])
+    rax.set_ylim(0, 2)
+    assert ax.calls == [] and rax.calls == []
+
+def test_calls_queued_with_queue(tmp_path):
+    plotlib.configure(str(tmp_path))
+    try:
+        fig, ax, rax = plotlib.fig_ratio()
+        ax.plot([1, 2], [3, 4])
+        fig.savefig("plot.pdf")
+    finally:
+        plotlib.configure(None)
+    assert ax.calls == [('plot', ([1, 2], [3, 4]), {})]
+    assert len(os.listdir(tmp_path)) == 1
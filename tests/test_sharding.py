@@ -0,0 +1,93 @@
+import importlib.util
+import os
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import yaml
+
+from benchmark import synthetic_tensor
+from cachelib import cache_key
+from configlib import DEFAULT_CONFIG, load_config
+
+pjoin = os.path.join
+
+SCRIPT = pjoin(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_driven_qcd.py")
+REGION = 'cr_qcd_j'
+
+def setup(tmp_path):
+    '''
+    Small config on top of the default one, with a synthetic input tensor in the cache.
+    '''
+    with open(DEFAULT_CONFIG) as f:
+        config = yaml.safe_load(f)
+    config['indir'] = str(tmp_path / "input")
+    config['outdir'] = str(tmp_path / "output")
+    config['regions'] = [REGION]
+    config['bins'] = {REGION : {'nom' : config['bins'][REGION]['nom'], 'alt3' : config['bins'][REGION]['alt3']}}
+    if importlib.util.find_spec('uproot') is None:
+        config['stages'] = [x for x in config['stages'] if x != 'prediction']
+    os.makedirs(config['indir'])
+    path = str(tmp_path / "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+    # --stream picks up the cached tensor instead of reading the input
+    config = load_config(path)
+    cachedir = str(tmp_path / "cache")
+    os.makedirs(cachedir)
+    extra = ('stream', config['regions'], config['years'], config['groups'])
+    key = cache_key(config['indir'], config['distribution'], True, extra)
+    tensor = synthetic_tensor(config['regions'], config['years'], np.linspace(150, 1500, 55), np.linspace(0, np.pi, 33))
+    with open(pjoin(cachedir, f"{config['distribution']}_{key[:16]}.pkl"), "wb") as f:
+        pickle.dump(tensor, f)
+    return path, cachedir, config['outdir']
+
+def run(path, cachedir, *args):
+    result = subprocess.run(
+        [sys.executable, SCRIPT, *args, '--stream', '--no-plots', '--config', path, '--cachedir', cachedir],
+        cwd=os.path.dirname(path), capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+def test_merge_after_single_shard(tmp_path):
+    path, cachedir, outdir = setup(tmp_path)
+    run(path, cachedir, 'run', '--shard', '0/1')
+    run(path, cachedir, 'merge')
+    assert os.path.exists(pjoin(outdir, f"tf_fits_{REGION}.npy"))
+
+def outputs(outdir):
+    '''
+    Content of every array written to outdir, by file name.
+    '''
+    arrays = {}
+    for name in sorted(os.listdir(outdir)):
+        if name.endswith(".npy"):
+            array = np.load(pjoin(outdir, name))
+            arrays[name] = (array.dtype, array.tobytes())
+    return arrays
+
+def test_shards_match_single_process(tmp_path):
+    path, cachedir, outdir = setup(tmp_path)
+    run(path, cachedir, 'run')
+    single = outputs(outdir)
+
+    for name in os.listdir(outdir):
+        os.remove(pjoin(outdir, name))
+    nshards = 3
+    shards = [
+        subprocess.Popen(
+            [sys.executable, SCRIPT, 'run', '--shard', f'{i}/{nshards}', '--stream', '--no-plots', '--config', path, '--cachedir', cachedir],
+            cwd=os.path.dirname(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        for i in range(nshards)
+    ]
+    for shard in shards:
+        _, stderr = shard.communicate()
+        assert shard.returncode == 0, stderr
+    run(path, cachedir, 'merge')
+    sharded = outputs(outdir)
+
+    assert f"tf_fits_{REGION}.npy" in single
+    assert sharded == single
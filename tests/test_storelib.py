@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from fitlib import TFFit, exponential, exponential2
+from storelib import (FitStore, PredictionWriter, fit_record, read_records,
+                      template_record, write_fit_store, write_template_store)
+
+def prediction(path, scale):
+    edges = np.array([250., 300., 400.])
+    sumw = scale * np.array([0., 2., 1., 0.])
+    records = [template_record("prediction", 2017, name, edges, sumw, sumw) for name in ["qcd_monov_2017", "qcd_monov_2017_qcdfit_monov_2017Up"]]
+    write_template_store(path, records)
+    return path
+
+def test_regions_keep_their_shape_names(tmp_path):
+    writer = PredictionWriter()
+    writer.add_store(prediction(str(tmp_path / "tight.npy"), 1), directory="cr_qcd_tight_v")
+    writer.add_store(prediction(str(tmp_path / "loose.npy"), 2), directory="cr_qcd_loose_v")
+    assert sorted(writer.shapes) == [
+        "cr_qcd_loose_v/qcd_monov_2017",
+        "cr_qcd_loose_v/qcd_monov_2017_qcdfit_monov_2017Up",
+        "cr_qcd_tight_v/qcd_monov_2017",
+        "cr_qcd_tight_v/qcd_monov_2017_qcdfit_monov_2017Up",
+    ]
+    assert np.array_equal(writer.shapes["cr_qcd_loose_v/qcd_monov_2017"][1], 2*writer.shapes["cr_qcd_tight_v/qcd_monov_2017"][1])
+    # All shapes share one edges array
+    assert len(writer.edges) == 1
+
+def test_duplicate_shape_in_directory(tmp_path):
+    writer = PredictionWriter()
+    path = prediction(str(tmp_path / "tight.npy"), 1)
+    writer.add_store(path, directory="cr_qcd_tight_v")
+    with pytest.raises(ValueError, match="Duplicate"):
+        writer.add_store(path, directory="cr_qcd_tight_v")
+
+def test_toys_survive_the_fit_store(tmp_path):
+    x = np.linspace(250, 1400, 12)
+    y = 0.5*np.exp(-4e-3*x) + 0.01
+    fits = {}
+    for tag, fun, ntoys in [("nominal_bin_nom", exponential, 100), ("nominal_bin_alt", exponential2, 50), ("closure_0p2_bin_nom", exponential, 0)]:
+        fit = TFFit(x, y, 0.05*y, fun)
+        fit.fit()
+        if ntoys:
+            fit.fit_toys(ntoys=ntoys, seed=2)
+        fits[tag] = fit
+    path = str(tmp_path / "tf_fits.npy")
+    write_fit_store(path, [fit_record(2017, tag, fit) for tag, fit in fits.items()])
+
+    records = read_records(path)
+    assert [r['tag'] + "_bin_" + r['bintag'] for r in records] == list(fits)
+    store = FitStore(path)
+    for record, (tag, fit) in zip(records, fits.items()):
+        toys = getattr(fit, 'toy_parameters', np.zeros((0, len(fit.pars['best']))))
+        # Toys of the model with fewer parameters come back without padding
+        assert np.array_equal(record['toys'], toys)
+        result = store.get(2017, *tag.split("_bin_"))
+        if len(toys):
+            assert np.array_equal(result.toy_envelope(x), fit.toy_envelope(x))
+        else:
+            assert len(result.toy_parameters) == 0
+
+    # Rewriting the records read back gives the same store
+    write_fit_store(str(tmp_path / "copy.npy"), records)
+    for a, b in zip(read_records(str(tmp_path / "copy.npy")), records):
+        assert np.array_equal(a['toys'], b['toys'])
@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+import pytest
+
+from templatelib import GROUPS, QCDTensor, hist_index, rebin_map, slice_indices
+
+REGIONS = ['cr_qcd_j']
+YEARS = [2017]
+
+# Flow-inclusive axis of these edges: 0 underflow, 1-3 bins, 4 overflow, 5 nan-flow
+EDGES = np.array([0., 1., 2., 3.])
+
+def test_slice_indices_open():
+    assert slice_indices(EDGES, slice(None, None)) == (0, 6)
+    # An open start includes the underflow, an open stop overflow and nan-flow
+    assert slice_indices(EDGES, slice(None, 2.)) == (0, 3)
+    assert slice_indices(EDGES, slice(1., None)) == (2, 6)
+
+def test_slice_indices_on_edges():
+    # A stop exactly on an edge ends before the bin starting there
+    assert slice_indices(EDGES, slice(0., 2.)) == (1, 3)
+    assert slice_indices(EDGES, slice(0., 1.)) == (1, 2)
+
+def test_slice_indices_inside_bins():
+    # As in coffea's integrate, the bin containing the start is included,
+    # the one containing the stop is not
+    assert slice_indices(EDGES, slice(0.5, 2.5)) == (1, 3)
+
+def test_rebin_map_by_centers():
+    fine = np.array([0., 1., 2., 3., 4.])
+    # New axis: 0 underflow, 1 [1, 3), 2 overflow, 3 dropped nan-flow
+    assert list(rebin_map(fine, [1., 3.])) == [0, 0, 1, 1, 2, 2, 3]
+    # Fine bins straddling a new edge go where their center is
+    assert list(rebin_map(fine, [0., 1.4, 4.])) == [0, 1, 2, 2, 2, 3, 4]
+
+def tensor():
+    '''
+    Hand-built tensor with one region, group and year and distinct contents per bin.
+    '''
+    recoil_edges = np.array([0., 1., 2., 3., 4.])
+    dphi_edges = np.array([0., 1., 2.])
+    sumw = np.arange(7*5, dtype=float).reshape(1, 1, 1, 7, 5)
+    return QCDTensor(REGIONS, ['qcd'], YEARS, recoil_edges, dphi_edges, sumw, 2*sumw)
+
+def test_templates_by_hand():
+    t = tensor()
+    w = t.sumw[0, 0, 0]
+    ret = t.templates(REGIONS[0], YEARS[0], [1., 3.], dphi_cr=slice(0., 1.), dphi_sr=slice(1., None))
+    cr = w[:, 1:2].sum(axis=1)
+    sr = w[:, 2:].sum(axis=1)
+    # Underflow and the first fine bin, two fine bins, the rest without nan-flow
+    for selection, expected in [("cr", cr), ("sr", sr)]:
+        sumw, sumw2 = ret[(selection, 'qcd')]
+        assert np.allclose(sumw, [expected[:2].sum(), expected[2:4].sum(), expected[4:6].sum()])
+        assert np.allclose(sumw2, 2*sumw)
+
+def test_scan_matches_templates():
+    t = tensor()
+    cr_sumw, cr_sumw2, sr_sumw, sr_sumw2 = t.scan(REGIONS[0], YEARS[0], [1., 3.], [1.], dphi_cut=2.)
+    ret = t.templates(REGIONS[0], YEARS[0], [1., 3.], dphi_cr=slice(0., 1.), dphi_sr=slice(1., 2.))
+    assert np.allclose(cr_sumw[0, 0], ret[("cr", 'qcd')][0])
+    assert np.allclose(sr_sumw[0, 0], ret[("sr", 'qcd')][0])
+    assert np.allclose(sr_sumw2[0, 0], ret[("sr", 'qcd')][1])
+
+def histogram(datasets):
+    hist = pytest.importorskip("coffea.hist")
+    h = hist.Hist(
+                "Events",
+                hist.Cat("dataset", "Dataset"),
+                hist.Cat("region", "Region"),
+                hist.Bin("recoil", "Recoil (GeV)", np.linspace(0, 1000, 11)),
+                hist.Bin("dphi", r"$\Delta\phi$", np.linspace(0, np.pi, 5)),
+                )
+    for i, dataset in enumerate(datasets):
+        h.fill(dataset=dataset, region=REGIONS[0], recoil=np.full(i+1, 250.), dphi=np.full(i+1, 0.1))
+    return h
+
+def test_stale_index_is_rejected():
+    old = histogram(['MET_2017C', 'QCD_HT1000to1500_2017'])
+    new = histogram(['MET_2017C', 'MET_2017D', 'QCD_HT1000to1500_2017'])
+    with pytest.raises(ValueError):
+        QCDTensor.from_hist(new, REGIONS, YEARS, index=hist_index(old, GROUPS, YEARS))
+
+def test_index_matches_computed():
+    h = histogram(['MET_2017C', 'MET_2017D', 'QCD_HT1000to1500_2017'])
+    computed = QCDTensor.from_hist(h, REGIONS, YEARS)
+    given = QCDTensor.from_hist(h, REGIONS, YEARS, index=hist_index(h, computed.groups, YEARS))
+    assert np.array_equal(computed.sumw, given.sumw)
+    assert computed.sumw.sum() == 6
+
+def test_templates_match_coffea():
+    hist = pytest.importorskip("coffea.hist")
+    rng = np.random.default_rng(1)
+    datasets = ['MET_2017C', 'QCD_HT1000to1500_2017', 'ZJetsToNuNu_HT200_2017']
+    h = hist.Hist(
+                "Events",
+                hist.Cat("dataset", "Dataset"),
+                hist.Cat("region", "Region"),
+                hist.Bin("recoil", "Recoil (GeV)", np.linspace(100, 1500, 29)),
+                hist.Bin("dphi", r"$\Delta\phi$", np.linspace(0, np.pi, 17)),
+                )
+    for dataset in datasets:
+        n = 5000
+        # Values outside the axes and nan fill all flow bins
+        recoil = rng.uniform(0, 1700, n)
+        recoil[:50] = np.nan
+        dphi = rng.uniform(-0.2, 3.3, n)
+        dphi[50:100] = np.nan
+        h.fill(dataset=dataset, region=REGIONS[0], recoil=recoil, dphi=dphi, weight=rng.uniform(0.5, 1.5, n))
+
+    t = QCDTensor.from_hist(h, REGIONS, YEARS)
+    bins = [250., 300., 400., 600., 1000., 1400.]
+    dphi_cr, dphi_sr = slice(0., 0.5), slice(0.5, None)
+    ret = t.templates(REGIONS[0], YEARS[0], bins, dphi_cr=dphi_cr, dphi_sr=dphi_sr)
+    for name, patterns in GROUPS.items():
+        regex = re.compile('|'.join(f"(?:{p.format(year=YEARS[0])})" for p in patterns))
+        selected = h.integrate("region", REGIONS[0])[regex].integrate("dataset")
+        selected = selected.rebin("recoil", hist.Bin("recoil", "Recoil (GeV)", bins))
+        for selection, dphi in [("cr", dphi_cr), ("sr", dphi_sr)]:
+            sumw, sumw2 = selected.integrate("dphi", dphi).values(sumw2=True, overflow='all')[()]
+            assert np.allclose(ret[(selection, name)][0], sumw)
+            assert np.allclose(ret[(selection, name)][1], sumw2)
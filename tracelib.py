@@ -0,0 +1,139 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Trace file, None disables tracing.
+# Set before any worker is forked, so the workers inherit it.
+_path = None
+_file = None
+_pid = None
+_lock = threading.Lock()
+
+# Labels of the enclosing spans, attached to every counter
+_context = {}
+
+# Returned by span() while tracing is off
+_null = contextlib.nullcontext()
+
+def configure(path):
+    '''
+    Enables tracing into a JSON lines file, one Chrome trace event per line.
+    '''
+    global _path, _file, _pid
+    _path = path
+    _file = None
+    _pid = None
+    if path is not None:
+        open(path, "w").close()
+
+def enabled():
+    return _path is not None
+
+def _write(event):
+    global _file, _pid
+    with _lock:
+        # Forked workers open their own handle and append to the same file
+        if _pid != os.getpid():
+            _file = open(_path, "a", buffering=1)
+            _pid = os.getpid()
+        _file.write(json.dumps(event, default=str) + "\n")
+
+def _now():
+    return time.time_ns() / 1e3
+
+class _Span():
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        global _context
+        self.outer = _context
+        _context = dict(_context, **self.labels)
+        self.args = _context
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        global _context
+        end = _now()
+        _context = self.outer
+        _write(dict(
+            name=self.name,
+            ph="X",
+            ts=self.start,
+            dur=end - self.start,
+            pid=os.getpid(),
+            tid=threading.get_ident(),
+            args=self.args,
+        ))
+        return False
+
+def span(name, **labels):
+    '''
+    Context manager timing a block, e.g. a stage for one region/year/tag.
+    '''
+    if _path is None:
+        return _null
+    return _Span(name, labels)
+
+def count(name, value=1, **labels):
+    '''
+    Records a counter value, e.g. function evaluations of a fit.
+    '''
+    if _path is None:
+        return
+    _write(dict(
+        name=name,
+        ph="C",
+        ts=_now(),
+        pid=os.getpid(),
+        tid=threading.get_ident(),
+        args=dict(_context, value=value, **labels),
+    ))
+
+def written(path, **labels):
+    '''
+    Records the size of a file that was just written.
+    '''
+    if _path is None:
+        return
+    count("bytes_written", os.path.getsize(path), path=path, **labels)
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def to_chrome(path, outpath):
+    '''
+    Converts a JSON lines trace into a Chrome trace file (chrome://tracing, Perfetto).
+    '''
+    events = []
+    for event in read_trace(path):
+        if event['ph'] == 'C':
+            # Chrome plots counters by name and args, keep the value only
+            event = dict(event, args={'value' : event['args']['value']})
+        events.append(event)
+    with open(outpath, "w") as f:
+        json.dump({"traceEvents" : events}, f)
+
+def summarize(path, by=()):
+    '''
+    Number of calls and totals per span or counter name, optionally
+    split by labels, e.g. by=('stage', 'region').
+
+    Totals are in seconds for spans and in the counter unit otherwise.
+    '''
+    summary = {}
+    for event in read_trace(path):
+        key = (event['name'],) + tuple(event['args'].get(x) for x in by)
+        entry = summary.setdefault(key, dict(calls=0, total=0.))
+        entry['calls'] += 1
+        if event['ph'] == 'X':
+            entry['total'] += event['dur'] / 1e6
+            entry['unit'] = 's'
+        else:
+            entry['total'] += event['args']['value']
+    return summary